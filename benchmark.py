@@ -0,0 +1,59 @@
+#!/usr/bin/env python3.13
+
+# Micro-benchmark of the database work behind a typical command such as /gifttokens:
+# a user check, a token read, a token update and a log insert.
+# "before" opens a new connection with default settings for every command, as the bot used to do.
+# "after" reuses the shared connection with WAL and the tuned pragmas.
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+import database
+
+def run_command(db, user_id):
+    database.check_user(db, user_id)
+    tokens = db.execute("SELECT u.tokens FROM user u WHERE u.user_id = ?", (user_id,)).fetchone()[0]
+    db.execute("UPDATE user SET tokens = :tokens WHERE user_id = :user_id", {"tokens":tokens+1, "user_id":user_id})
+    db.execute("INSERT INTO log (user_id, request_id, timestamp, class, cause_id, summary) VALUES (?,?,?,?,?,?)", (user_id, None, int(time.time()), 3, None, "Benchmark entry."))
+
+def time_commands(n, get_db, release_db):
+    timings = []
+    for i in range(n):
+        start = time.perf_counter()
+        db = get_db()
+        run_command(db, i % 50)
+        release_db(db)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95)]
+    print(f"{name}: mean {statistics.mean(timings):.3f}ms, median {statistics.median(timings):.3f}ms, p95 {p95:.3f}ms")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    os.chdir(tempfile.mkdtemp())
+
+    # Each variant gets its own file, since WAL mode is persistent once set on a database.
+    database.database_name = "before.db"
+    db = database.open_connection(tuned=False)
+    database.create_database(db, log=False)
+    db.close()
+    before = time_commands(n, lambda: database.open_connection(tuned=False), lambda db: db.close())
+
+    database.database_name = "after.db"
+    database.init_database()
+    after = time_commands(n, database.get_connection, lambda db: None)
+
+    print(f"Per-command latency over {n} commands:")
+    report("before (connection per command)", before)
+    report("after (shared tuned connection)", after)
+
+    database.close_database()
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,17 @@ import discord
 import datetime
 import asyncio
 import sys
+import os
+import tempfile
 import time
 from discord import Forbidden, app_commands
-from discord.ext import tasks
 import sqlite3
-from database import check_user, check_request
+from database import check_request, load_user_state, load_rankings, reset_season, get_season, season_leaderboard, fetch_log_trees, iter_log_batches, archive_log_batch, historic_counters, ranked_counters, season_counters, run_transaction, LogWriter, CounterOutOfBounds, RowStateChanged, update_user_counter, update_request_counter, write_log_entries
+from messaging import OutboundQueue, Priority, chunk_lines
+from cache import LRUCache, TTLCache
+from ranking import RankIndex
+from exportlog import row_writer
+from scheduler import Scheduler, next_weekly, next_monthly, next_interval
 import textwrap
 
 from enum import Enum
@@ -46,6 +52,15 @@ class RequestType(Enum):
     PROFILE = 10
     FEEDBACK_ON_FEEDBACK = 11
 
+class SeasonBoard(Enum):
+    STARS = "stars"
+    MAPPER_UPVOTES = "mapper_upvotes"
+    CRITIC_UPVOTES = "critic_upvotes"
+
+class ExportFormat(Enum):
+    CSV = "csv"
+    JSONL = "jsonl"
+
 class CriticsGuildButler(discord.Client):   
     def __init__(self, *, db_connect, 
                  server_ids, bot_id, 
@@ -60,6 +75,7 @@ class CriticsGuildButler(discord.Client):
                  leaderboard_task_weekday, leaderboard_task_hour,
                  token_cycle_task_monthday, token_cycle_task_hour,
                  token_decay,
+                 log_archive_days,
                  print_log=True):      
         intents = discord.Intents.default()
         intents.message_content = True
@@ -101,17 +117,81 @@ class CriticsGuildButler(discord.Client):
 
         self.token_decay = token_decay
 
+        self.log_archive_days = log_archive_days
+
         self.print_log = print_log
 
+        self.leaderboard_page_size = 10
+        # Characters per page of longer embeds, below Discord's limit of 4096 for an embed description.
+        self.embed_page_limit = 4000
+        # How many users above and below are shown around a user by /rank.
+        self.rank_neighbours = 2
+
         super().__init__(intents=intents)
 
         self.tree = app_commands.CommandTree(self)
         self.server_obj = None
 
+        # Threads waiting for react_sleep to elapse before being processed, by thread id.
+        self.pending_threads = {}
+        self.pending_threads_task = None
+        self.background_tasks = set()
+
+        # Every message to a channel, thread or DM goes through this queue, log lines in its low priority lane.
+        self.outbound = OutboundQueue()
+        self.log_writer = LogWriter(self.db_connect(), on_error=self.log_write_error)
+
+        # Periodic tasks, whose last runs are kept in the database so that runs missed while the bot was down are caught up.
+        self.scheduler = Scheduler(self.db_connect(), on_error=self.scheduled_task_error)
+        self.scheduler.add("leaderboards", lambda last_run: next_weekly(last_run, self.leaderboard_task_weekday, self.leaderboard_task_hour), self.show_leaderboards)
+        self.scheduler.add("token_cycle", lambda last_run: next_monthly(last_run, self.token_cycle_task_monthday, self.token_cycle_task_hour), self.token_cycle)
+        self.scheduler.add("log_archival", lambda last_run: next_interval(last_run, 86400), self.log_archival)
+
+        # Tokens, penalties, claimed tokens and active requests of recently seen users, kept up to date by update_counters.
+        self.user_cache = LRUCache()
+
+        # Channels, members and users fetched over REST, for when the gateway cache does not hold them.
+        self.object_cache = TTLCache()
+        self.lookup_counts = {"gateway":0, "cache":0, "rest":0}
+
+        # Users sorted by each leaderboard counter, kept up to date by update_counters.
+        self.rankings = {counter: RankIndex() for counter in ranked_counters}
+
+        # How new requests are taken in on each list: (name, who may respond, token costs, token rewards), costs and rewards by request type.
+        # Requests in the open list are free and reward 1 token.
+        self.intake_lists = {
+            RequestList.OPEN: ("open list", None, None, [1 for request_type in RequestType]),
+            RequestList.CRITIC: ("critics list", "critics", critic_list_token_costs, critic_list_token_rewards),
+            RequestList.TRUSTED_CRITIC: ("trusted critics list", "trusted critics", trusted_critic_list_token_costs, trusted_critic_list_token_rewards)
+        }
+        self.intake_timings = {}
+
+        # (token cost, token reward) of every kind of request, by (list, request type).
+        self.request_prices = {}
+        for (list_option, (list_name, responders, token_costs, token_rewards)) in self.intake_lists.items():
+            for (i, token_reward) in enumerate(token_rewards):
+                self.request_prices[(list_option, RequestType(i+1))] = (0 if token_costs is None else token_costs[i], token_reward)
+
+        # The list of every list channel, and (list, request type, token cost, token reward) by (list channel, tag), so that routing and pricing a thread are lookups.
+        list_tags = {
+            RequestList.OPEN: (open_list_channel_id, open_list_tag_ids),
+            RequestList.CRITIC: (critic_list_channel_id, critic_list_tag_ids),
+            RequestList.TRUSTED_CRITIC: (trusted_critic_list_channel_id, trusted_critic_list_tag_ids)
+        }
+        self.list_channels = {channel_id: list_option for (list_option, (channel_id, tag_ids)) in list_tags.items()}
+        self.request_kinds = {}
+        for (list_option, (channel_id, tag_ids)) in list_tags.items():
+            for (i, tag_id) in enumerate(tag_ids):
+                request_type = RequestType(i+1)
+                self.request_kinds[(channel_id, tag_id)] = (list_option, request_type, *self.request_prices[(list_option, request_type)])
+
     
     async def setup_hook(self):
         db = self.db_connect()
 
+        self.log_writer.start()
+        await db.run(load_rankings, self.rankings)
+
         self.add_commands()
 
         # This copies the global commands over to the guilds.
@@ -127,17 +207,21 @@ class CriticsGuildButler(discord.Client):
         await self.server_obj.fetch_roles()
 
         self.log_channel_obj = await self.fetch_channel(self.log_channel_id)
+        self.outbound.start()
         self.trusted_critic_role_obj = await self.server_obj.fetch_role(self.trusted_critic_role_id)        
 
         # Start periodic tasks
-        if not self.show_leaderboards.is_running():
-            self.show_leaderboards.start()
-        if not self.token_cycle.is_running():
-            self.token_cycle.start()
+        await self.scheduler.start()
 
         await self.log_system(db,f"Butler ready. Version info: {butler_version}")
 
         return
+
+    async def close(self):
+        self.scheduler.stop()
+        await self.log_writer.stop()
+        await self.outbound.stop()
+        await super().close()
     
     class CompletedVoteMapper(discord.ui.View):
         def __init__(self,bot_obj,request_id,mapper_id):
@@ -153,12 +237,9 @@ class CriticsGuildButler(discord.Client):
             user_mention = self.bot_obj.mention_user(interaction.user.id)
             target_user_mention = self.bot_obj.mention_user(self.mapper_id)
 
-            def update_upvotes(previous):
-                return previous+1
-
             await interaction.message.edit(view=None)            
             command_id = await self.bot_obj.log_command(db,f"{user_mention} (critic) upvoted {target_user_mention} (mapper).",interaction.user.id,request_id=self.request_id)
-            await self.bot_obj.update_mapper_upvotes(db,self.mapper_id,update_upvotes,self.request_id,cause_id = command_id)
+            await self.bot_obj.update_mapper_upvotes(db,self.mapper_id,delta=1,request_id=self.request_id,cause_id = command_id)
             await self.bot_obj.send_dm(interaction.user,f"Upvoted!")
 
             db.close()
@@ -181,15 +262,12 @@ class CriticsGuildButler(discord.Client):
             user_mention = self.bot_obj.mention_user(interaction.user.id)
             target_user_mention = self.bot_obj.mention_user(self.critic_id)
 
-            def update_upvotes(previous):
-                return previous+1
-
             if interaction.message.flags.ephemeral:
                 await interaction.response.edit_message(content="Upvoted!",view=None)
             else:
                 await interaction.message.edit(content="Upvoted!",view=None)            
             command_id = await self.bot_obj.log_command(db,f"{user_mention} (mapper) upvoted {target_user_mention} (critic).",interaction.user.id,request_id=self.request_id)
-            await self.bot_obj.update_critic_upvotes(db,self.critic_id,update_upvotes,self.request_id,cause_id = command_id)
+            await self.bot_obj.update_critic_upvotes(db,self.critic_id,delta=1,request_id=self.request_id,cause_id = command_id)
             
             db.close()
 
@@ -200,11 +278,47 @@ class CriticsGuildButler(discord.Client):
             else:
                 await interaction.message.edit(view=None)              
     
+    # Shows one page of an embed at a time, with buttons to move between pages.
+    class EmbedPages(discord.ui.View):
+        def __init__(self,bot_obj,title,pages):
+            super().__init__(timeout=86400)
+            self.bot_obj : CriticsGuildButler = bot_obj
+            self.title = title
+            self.pages = pages
+            self.page = 0
+            self.message = None
+            self.update_buttons()
+
+        def update_buttons(self):
+            self.previous_page.disabled = (self.page == 0)
+            self.next_page.disabled = (self.page == len(self.pages) - 1)
+
+        async def show_page(self, interaction: discord.Interaction, page):
+            self.page = page
+            self.update_buttons()
+            await interaction.response.edit_message(embed=self.bot_obj.page_embed(self.title,self.pages,self.page),view=self)
+
+        @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, emoji="◀️")
+        async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+            await self.show_page(interaction, self.page - 1)
+
+        @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, emoji="▶️")
+        async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+            await self.show_page(interaction, self.page + 1)
+
+        async def on_timeout(self):
+            if not self.message is None:
+                try:
+                    await self.message.edit(view=None)
+                except discord.HTTPException:
+                    pass
+
     async def on_thread_create(self, thread: discord.Thread):
-        await self.process_thread(thread)
+        self.defer_thread(thread, self.process_thread)
 
     async def on_thread_delete(self, thread: discord.Thread):
-        await self.process_thread_deleted(thread)
+        self.object_cache.invalidate(("channel", thread.id))
+        self.defer_thread(thread, self.process_thread_deleted)
 
     async def on_message(self, message):
         await self.process_message(message)
@@ -268,10 +382,23 @@ class CriticsGuildButler(discord.Client):
         else:
             return f"{n}♻️completed mapper requests"            
 
-    def calculate_cumulative_tokens(self, n, thread_date):
-        naive = thread_date.replace(tzinfo=None)
-        delta_creation = datetime.datetime.now() - naive
-        days_since_creation = delta_creation.days
+    # (counter, board name, value formatter) of the leaderboards shown by /rank.
+    def rank_boards(self):
+        return [
+            ("tokens", "Tokens", self.tokens),
+            ("stars", "Stars", self.stars),
+            ("critic_upvotes", "Critic upvotes", self.upvotes),
+            ("mapper_upvotes", "Mapper upvotes", self.upvotes),
+            ("completed_critic_requests", "Critic completions", self.completed_critic_requests),
+            ("completed_mapper_requests", "Mapper completions", self.completed_mapper_requests)
+        ]
+
+    # Whole days elapsed since a timestamp in seconds since the epoch.
+    def days_since(self, timestamp):
+        return (int(time.time()) - timestamp) // 86400
+
+    def calculate_cumulative_tokens(self, n, created_at):
+        days_since_creation = self.days_since(created_at)
         if days_since_creation < self.days_double_tokens:
             return n
         else:
@@ -281,309 +408,359 @@ class CriticsGuildButler(discord.Client):
     # Discord / database logic and presentation methods
     ###
         
-    async def display_request(self, thread_id):
-        thread:discord.Thread = await self.fetch_channel(thread_id)
-
-        # For now we just provide the link.
-        return thread.jump_url    
-
-    async def update_tokens_request(self, db, request_id, update_fun, cause_id = None, **kwargs):
-        cur = db.cursor()
-
-        query = """
-            SELECT
-                r.additional_tokens
-            FROM request r
-            WHERE r.thread_id = ?
-            """
-        res = cur.execute(query,(request_id,))
-        previous_tokens = res.fetchone()[0]
-
-        new_tokens = update_fun(previous_tokens)
-
-        query_update = """
-            UPDATE request
-            SET additional_tokens = :tokens
-            WHERE thread_id = :request_id
-        """
-        data = {"tokens":new_tokens, "request_id":request_id}
-        cur.execute(query_update,data)
-
-        return (previous_tokens,new_tokens)
-
-    async def update_tokens(self, db, user_id, update_fun, request_id = None, cause_id = None, **kwargs):
-        cur = db.cursor()
-
-        check_user(db, user_id)
-
-        query = """
-            SELECT
-                u.tokens
-            FROM user u
-            WHERE u.user_id = ?
-            """
-        res = cur.execute(query,(user_id,))
-        previous_tokens = res.fetchone()[0]
-
-        new_tokens = update_fun(previous_tokens)
-
-        query_update = """
-            UPDATE user
-            SET tokens = :tokens
-            WHERE user_id = :user_id
-        """
-        data = {"tokens":new_tokens, "user_id":user_id}
-        cur.execute(query_update,data)
-
-        await self.log_tokens(db, user_id, previous_tokens, new_tokens, request_id, cause_id, **kwargs)
+    # Object lookups. These prefer the gateway cache, then objects recently fetched over REST, and only then make a REST call.
+    async def lookup(self, key, get, fetch, object_id):
+        obj = get(object_id)
+        if not obj is None:
+            self.lookup_counts["gateway"] += 1
+            return obj
+
+        obj = self.object_cache.get((key, object_id))
+        if not obj is None:
+            self.lookup_counts["cache"] += 1
+            return obj
+
+        obj = await fetch(object_id)
+        self.lookup_counts["rest"] += 1
+        self.object_cache.put((key, object_id), obj)
+        return obj
+
+    # Where object lookups were served from, and the hit rates of the user and object caches, to check how many REST calls are avoided.
+    def cache_summary(self):
+        lookups = sum(self.lookup_counts.values())
+        lines = [f"Object lookups: {lookups} ({', '.join(f'{count} {source}' for (source, count) in self.lookup_counts.items())})"]
+
+        for (name, cache) in [("User cache", self.user_cache), ("Object cache", self.object_cache)]:
+            requests = cache.hits + cache.misses
+            hit_rate = 0 if requests == 0 else 100*cache.hits/requests
+            lines.append(f"{name}: {len(cache)} entries, {cache.hits} hits, {cache.misses} misses ({hit_rate:.0f}% hit rate)")
+
+        return "\n".join(lines)
+
+    async def lookup_channel(self, channel_id):
+        return await self.lookup("channel", self.get_channel, self.fetch_channel, channel_id)
+
+    # server_obj is fetched over REST and has no members, so cached members come from the gateway guild instead.
+    # That guild is only known once the bot has connected.
+    def get_member(self, user_id):
+        guild = self.get_guild(self.server_obj.id)
+        return None if guild is None else guild.get_member(user_id)
+
+    async def lookup_member(self, user_id):
+        return await self.lookup("member", self.get_member, self.server_obj.fetch_member, user_id)
+
+    async def lookup_user(self, user_id):
+        return await self.lookup("user", self.get_user, self.fetch_user, user_id)
+
+    # Discord renders a channel mention as a link to the thread, so listings do not need to look each thread up.
+    def mention_request(self, thread_id):
+        return f"<#{thread_id}>"
+
+    # Summary of the log entry written when a user counter changes.
+    def counter_summary(self, user_id, counter, previous, new):
+        user_mention = self.mention_user(user_id)
 
-        return (previous_tokens,new_tokens)
+        if counter == "tokens":
+            return f"{user_mention} went from {self.tokens(previous)} to {self.tokens(new)}."
+        elif counter == "mapper_upvotes":
+            return f"{user_mention} went from {self.upvotes(previous)} to {self.upvotes(new)} (mapper)."
+        elif counter == "critic_upvotes":
+            return f"{user_mention} went from {self.upvotes(previous)} to {self.upvotes(new)} (critic)."
+        elif counter == "stars":
+            return f"{user_mention} went from {self.stars(previous)} to {self.stars(new)}."
+        elif counter == "penalties":
+            return f"{user_mention} went from {self.penalties(previous)} to {self.penalties(new)}."
+        elif counter == "completed_critic_requests":
+            return f"{user_mention} went from {self.completed_critic_requests(previous)} to {self.completed_critic_requests(new)}."
+        elif counter == "completed_mapper_requests":
+            return f"{user_mention} went from {self.completed_mapper_requests(previous)} to {self.completed_mapper_requests(new)}."
+
+        return f"{user_mention} went from {previous} to {new} {counter}."
+
+    # Applies a list of counter changes, and writes a log entry for each user counter change, all in a single transaction.
+    # Each change is a dict with either "user_id" or "request_id", the "counter" column, and either "delta" or "value".
+    # Optional keys: "minimum" and "maximum" bounds, "update_historic" (default True) and "log" (default True) for user counters.
+    # Returns the list of (previous, new) pairs, or None if a change was out of bounds, in which case nothing was changed.
+    # prepare, if given, is run on the worker in the same transaction before the changes, e.g. to insert or move the row the changes depend on.
+    # What it returns is passed to any "delta" that is a function, and returning None rolls everything back, also returning None.
+    # A user counter change whose delta is a function is not logged if the delta turns out to be 0.
+    async def update_counters(self, db, changes, request_id = None, cause_id = None, prepare = None):
+        timestamp = int(time.time())
+
+        log_ids = []
+        for change in changes:
+            if "user_id" in change and change.get("log", True):
+                log_ids.append(await self.log_writer.reserve())
+            else:
+                log_ids.append(None)
+
+        def apply_changes(conn):
+            results = []
+            entries = []
+
+            prepared = None
+            if not prepare is None:
+                prepared = prepare(conn)
+                if prepared is None:
+                    raise RowStateChanged()
+
+            for (change, log_id) in zip(changes, log_ids):
+                delta = change.get("delta")
+                if callable(delta):
+                    delta = delta(prepared)
+                    if delta == 0:
+                        log_id = None
+
+                if "user_id" in change:
+                    result = update_user_counter(conn, change["user_id"], change["counter"], delta, change.get("value"), change.get("update_historic", True), change.get("minimum"), change.get("maximum"))
+
+                    if not log_id is None:
+                        (previous, new) = result
+                        summary = self.counter_summary(change["user_id"], change["counter"], previous, new)
+                        entries.append((log_id, change["user_id"], request_id, timestamp, LogClass.RESULT.value, cause_id, summary))
+                else:
+                    result = update_request_counter(conn, change["request_id"], change["counter"], delta, change.get("value"), change.get("minimum"), change.get("maximum"))
 
-    async def update_stars(self, db, user_id, update_fun, request_id = None, cause_id = None, update_historic=True, **kwargs):
-        cur = db.cursor()
+                results.append(result)
 
-        check_user(db, user_id)
+            write_log_entries(conn, entries)
 
-        query = """
-            SELECT
-                u.stars,
-                u.historic_stars
-            FROM user u
-            WHERE u.user_id = ?
-            """
-        res = cur.execute(query,(user_id,))
-        (previous_stars, previous_historic_stars) = res.fetchone()        
+            return (results, entries)
 
-        new_stars = update_fun(previous_stars)
+        # Runs in the same worker call as the commit, so that no cache fill can be interleaved between the two.
+        def apply_and_cache(conn):
+            (results, entries) = run_transaction(conn, apply_changes)
 
-        if update_historic:
-            diff_stars = new_stars - previous_stars
-            new_historic_stars = previous_historic_stars + diff_stars
+            for (change, (previous, new)) in zip(changes, results):
+                if "user_id" in change:
+                    self.user_cache.update(change["user_id"], change["counter"], new)
+                    self.update_rankings(change["user_id"], change["counter"], previous, new, change.get("update_historic", True))
 
-            query_update = """
-                UPDATE user
-                SET stars = :stars, historic_stars = :historic_stars
-                WHERE user_id = :user_id
-            """
-            data = {"stars":new_stars, "historic_stars":new_historic_stars, "user_id":user_id}
-            cur.execute(query_update,data)
-        else:
-            query_update = """
-                UPDATE user
-                SET stars = :stars
-                WHERE user_id = :user_id
-            """
-            data = {"stars":new_stars, "user_id":user_id}
-            cur.execute(query_update,data)
+            return (results, entries)
 
-        await self.log_stars(db, user_id, previous_stars, new_stars, request_id, cause_id, **kwargs)
-
-        return (previous_stars,new_stars)
-
-    async def update_mapper_upvotes(self, db, user_id, update_fun, request_id = None, cause_id = None, update_historic=True, **kwargs):
-        cur = db.cursor()
-
-        check_user(db, user_id)
-
-        query = """
-            SELECT
-                u.mapper_upvotes,
-                u.historic_mapper_upvotes
-            FROM user u
-            WHERE u.user_id = ?
-            """
-        res = cur.execute(query,(user_id,))
-        (previous_upvotes, previous_historic_upvotes) = res.fetchone()        
+        try:
+            (results, entries) = await db.run(apply_and_cache)
+        except (CounterOutOfBounds, RowStateChanged):
+            return None
 
-        new_upvotes = update_fun(previous_upvotes)
+        for (log_id, user_id, request_id, timestamp, log_class, cause_id, summary) in entries:
+            self.log_output(log_id, LogClass(log_class), summary, timestamp)
 
-        if update_historic:
-            diff_upvotes = new_upvotes - previous_upvotes
-            new_historic_upvotes = previous_historic_upvotes + diff_upvotes
+        return results
 
-            query_update = """
-                UPDATE user
-                SET mapper_upvotes = :upvotes, historic_mapper_upvotes = :historic_upvotes
-                WHERE user_id = :user_id
-            """
-            data = {"upvotes":new_upvotes, "historic_upvotes":new_historic_upvotes, "user_id":user_id}
-            cur.execute(query_update,data)
-        else:
-            query_update = """
-                UPDATE user
-                SET mapper_upvotes = :upvotes
-                WHERE user_id = :user_id
-            """
-            data = {"upvotes":new_upvotes, "user_id":user_id}
-            cur.execute(query_update,data)
+    def update_rankings(self, user_id, counter, previous, new, update_historic):
+        if counter in self.rankings:
+            self.rankings[counter].set(user_id, new)
 
-        await self.log_mapper_upvotes(db, user_id, previous_upvotes, new_upvotes, request_id, cause_id, **kwargs)
+        if update_historic and counter in historic_counters:
+            self.rankings[f"historic_{counter}"].add(user_id, new - previous)
 
-        return (previous_upvotes,new_upvotes)
+    # Returns a dict with the tokens, penalties, claimed_tokens and active_requests of a user, creating the user if needed.
+    # Returns None if the user does not exist and create is False.
+    async def get_user_state(self, db, user_id, create = True):
+        state = self.user_cache.get(user_id)
+        if not state is None:
+            return dict(state)
 
-    async def update_critic_upvotes(self, db, user_id, update_fun, request_id = None, cause_id = None, update_historic=True, **kwargs):
-        cur = db.cursor()
+        return await db.run(load_user_state, self.user_cache, user_id, create)
 
-        check_user(db, user_id)
+    async def check_user(self, db, user_id, create = True):
+        return not (await self.get_user_state(db, user_id, create)) is None
 
-        query = """
-            SELECT
-                u.critic_upvotes,
-                u.historic_critic_upvotes
-            FROM user u
-            WHERE u.user_id = ?
-            """
-        res = cur.execute(query,(user_id,))
-        (previous_upvotes, previous_historic_upvotes) = res.fetchone()        
+    # Saves and zeroes the season counters of all users in a single transaction, with one summary log entry instead of one per user.
+    # Returns (season_id, number of users saved).
+    async def reset_leaderboards(self, db, cause_id = None):
+        timestamp = int(time.time())
+        log_id = await self.log_writer.reserve()
 
-        new_upvotes = update_fun(previous_upvotes)
+        def reset(conn):
+            (season_id, n_users) = reset_season(conn, log_id)
+            summary = f"Season {season_id} ended: the {self.stars(-1)} and {self.upvotes(-1)} of {n_users} users were saved and reset to 0."
+            write_log_entries(conn, [(log_id, None, None, timestamp, LogClass.RESULT.value, cause_id, summary)])
+            return (season_id, n_users, summary)
 
-        if update_historic:
-            diff_upvotes = new_upvotes - previous_upvotes
-            new_historic_upvotes = previous_historic_upvotes + diff_upvotes
+        # The rankings are reloaded in the same worker call, so no counter change can slip in between.
+        def reset_and_reload(conn):
+            result = run_transaction(conn, reset)
+            load_rankings(conn, {counter: self.rankings[counter] for counter in season_counters})
+            return result
 
-            query_update = """
-                UPDATE user
-                SET critic_upvotes = :upvotes, historic_critic_upvotes = :historic_upvotes
-                WHERE user_id = :user_id
-            """
-            data = {"upvotes":new_upvotes, "historic_upvotes":new_historic_upvotes, "user_id":user_id}
-            cur.execute(query_update,data)
-        else:
-            query_update = """
-                UPDATE user
-                SET critic_upvotes = :upvotes
-                WHERE user_id = :user_id
-            """
-            data = {"upvotes":new_upvotes, "user_id":user_id}
-            cur.execute(query_update,data)
+        (season_id, n_users, summary) = await db.run(reset_and_reload)
+        self.log_output(log_id, LogClass.RESULT, summary, timestamp)
 
-        await self.log_critic_upvotes(db, user_id, previous_upvotes, new_upvotes, request_id, cause_id, **kwargs)
+        return (season_id, n_users)
 
-        return (previous_upvotes,new_upvotes)
+    # Single change versions of update_counters. Return (previous, new), or None if out of bounds.
+    async def update_user_counter(self, db, user_id, counter, delta = None, value = None, request_id = None, cause_id = None, update_historic = True, minimum = None):
+        change = {"user_id":user_id, "counter":counter, "delta":delta, "value":value, "update_historic":update_historic, "minimum":minimum}
+        results = await self.update_counters(db, [change], request_id = request_id, cause_id = cause_id)
 
-    async def update_penalties(self, db, user_id, update_fun, request_id = None, cause_id = None, **kwargs):
-        cur = db.cursor()
+        if results is None:
+            return None
 
-        check_user(db, user_id)
+        return results[0]
 
-        query = """
-            SELECT
-                u.penalties
-            FROM user u
-            WHERE u.user_id = ?
-            """
-        res = cur.execute(query,(user_id,))
-        previous_penalties = res.fetchone()[0]
+    async def update_tokens(self, db, user_id, delta = None, value = None, request_id = None, cause_id = None, minimum = None):
+        return await self.update_user_counter(db, user_id, "tokens", delta, value, request_id, cause_id, minimum = minimum)
 
-        new_penalties = update_fun(previous_penalties)
+    async def update_stars(self, db, user_id, delta = None, value = None, request_id = None, cause_id = None, update_historic=True):
+        return await self.update_user_counter(db, user_id, "stars", delta, value, request_id, cause_id, update_historic)
 
-        query_update = """
-            UPDATE user
-            SET penalties = :penalties
-            WHERE user_id = :user_id
-        """
-        data = {"penalties":new_penalties, "user_id":user_id}
-        cur.execute(query_update,data)
+    async def update_mapper_upvotes(self, db, user_id, delta = None, value = None, request_id = None, cause_id = None, update_historic=True):
+        return await self.update_user_counter(db, user_id, "mapper_upvotes", delta, value, request_id, cause_id, update_historic)
 
-        await self.log_penalties(db, user_id, previous_penalties, new_penalties, request_id, cause_id, **kwargs)
+    async def update_critic_upvotes(self, db, user_id, delta = None, value = None, request_id = None, cause_id = None, update_historic=True):
+        return await self.update_user_counter(db, user_id, "critic_upvotes", delta, value, request_id, cause_id, update_historic)
 
-        return (previous_penalties,new_penalties)    
+    async def update_penalties(self, db, user_id, delta = None, value = None, request_id = None, cause_id = None):
+        return await self.update_user_counter(db, user_id, "penalties", delta, value, request_id, cause_id)
 
-    async def get_request_type(self, db, thread: discord.Thread):
+    # Returns (list, request type, token cost, token reward) of a new request thread, or None if its forum or tag are unknown.
+    async def get_request_kind(self, db, thread: discord.Thread, cause_id=None):
         # We assume there is exactly one tag. Do not call this function unless this is checked        
         tag = thread.applied_tags[0]      
-        request_type = None
-        if thread.parent_id == self.open_list_channel_id:
-            list_option = RequestList.OPEN            
-            for i in range(len(self.open_list_tag_ids)):
-                if tag.id == self.open_list_tag_ids[i]:
-                    request_type = RequestType(i+1)
-        elif thread.parent_id == self.critic_list_channel_id:
-            list_option = RequestList.CRITIC
-            for i in range(len(self.critic_list_tag_ids)):
-                if tag.id == self.critic_list_tag_ids[i]:
-                    request_type = RequestType(i+1)
-        elif thread.parent_id == self.trusted_critic_list_channel_id:
-            list_option = RequestList.TRUSTED_CRITIC
-            for i in range(len(self.trusted_critic_list_tag_ids)):
-                if tag.id == self.trusted_critic_list_tag_ids[i]:
-                    request_type = RequestType(i+1)
-        else:
+
+        if not thread.parent_id in self.list_channels:
             await self.log_system(db, f"Unexpected forum thread encountered when creating new request: {thread.parent_id}",cause_id=cause_id)       
             return None
 
-        if request_type is None:
-            await self.log_system(db, f"Unexpected request type encountered on {list_option}: {tag.id} with label {tag.name}.",cause_id=cause_id)
+        kind = self.request_kinds.get((thread.parent_id, tag.id))
+        if kind is None:
+            await self.log_system(db, f"Unexpected request type encountered on {self.list_channels[thread.parent_id]}: {tag.id} with label {tag.name}.",cause_id=cause_id)
             return None
         
-        return (list_option,request_type)
+        return kind
 
-    async def create_request(self, db, thread: discord.Thread, cause_id=None):
+    # kind is the result of get_request_kind, if the caller already has it.
+    # The token cost is taken from the author in the same transaction that inserts the request, and the request is only created if the author
+    # can pay it and, if max_requests is given, does not go over that many active requests.
+    # Returns the (previous, new) active requests of the author as committed with the request, or None if the request was not created.
+    async def create_request(self, db, thread: discord.Thread, cause_id=None, kind=None, max_requests=None):
         thread_id = thread.id
         author_id = thread.owner_id
         
-        type_and_list = await self.get_request_type(db, thread)
+        if kind is None:
+            kind = await self.get_request_kind(db, thread, cause_id)
 
-        if type_and_list is None:
+        if kind is None:
             return None
 
-        (list_option, request_type) = type_and_list
-
-        cur = db.cursor()
+        (list_option, request_type, token_cost, token_reward) = kind
 
         query_create = """
             INSERT INTO request
-            (thread_id, author_id, list, critic_id, type, state)
+            (thread_id, author_id, list, critic_id, type, state, created_at)
             VALUES
-            (:thread_id, :author_id, :list, NULL, :type, :open_state)
+            (:thread_id, :author_id, :list, NULL, :type, :open_state, :created_at)
             """
-        data = {"thread_id":thread_id, "author_id":author_id, "list":list_option.value, "type":request_type.value, "open_state":RequestState.OPEN.value}
-        cur.execute(query_create,data)
+        created_at = int(discord.utils.snowflake_time(thread_id).timestamp())
+        data = {"thread_id":thread_id, "author_id":author_id, "list":list_option.value, "type":request_type.value, "open_state":RequestState.OPEN.value, "created_at":created_at}
+
+        def insert_request(conn):
+            conn.execute(query_create,data)
+            return True
+
+        # The insert trigger has already counted the request when the changes run, so a zero delta just checks the new count.
+        changes = [{"user_id":author_id, "counter":"active_requests", "delta":0, "maximum":max_requests, "log":False}]
+        if token_cost > 0:
+            changes.append({"user_id":author_id, "counter":"tokens", "delta":-token_cost, "minimum":0})
+
+        results = await self.update_counters(db,changes,request_id=thread_id,cause_id=cause_id,prepare=insert_request)
+        if results is None:
+            return None
 
         user_mention = self.mention_user(thread.owner_id)        
         await self.log_result(db,f"{user_mention} created request {thread.jump_url} of {request_type} in {list_option}.",thread.owner_id,request_id=thread_id,cause_id=cause_id)
 
-        return thread_id
+        return results[0]
 
-    async def calculate_request_tokens(self, db, thread_id):
-        cur = db.cursor()
+    def request_token_reward(self, list_option, request_type, additional_tokens, created_at):
+        (token_cost, token_reward) = self.request_prices[(list_option, request_type)]
+        return self.calculate_cumulative_tokens(token_reward,created_at)+additional_tokens
+
+    # (list, type, base reward) for every kind of request, as used by request_token_reward.
+    def base_token_rewards(self):
+        return [(list_option.value, request_type.value, token_reward) for ((list_option, request_type), (token_cost, token_reward)) in self.request_prices.items()]
+
+    # The open requests with the highest token rewards, computed and sorted by SQLite in a single query.
+    # The reward expression must match request_token_reward.
+    async def top_request_rewards(self, db, max_requests):
+        base_rewards = ", ".join(f"({list_option_id}, {type_id}, {int(n)})" for (list_option_id, type_id, n) in self.base_token_rewards())
+
+        query = f"""
+            WITH base (list, type, tokens) AS (VALUES {base_rewards})
+            SELECT
+                r.thread_id,
+                r.author_id,
+                r.list,
+                r.critic_id,
+                r.type,
+                r.created_at,
+                CASE
+                    WHEN (:now - r.created_at) / 86400 < :days_double_tokens THEN b.tokens
+                    ELSE b.tokens + (b.tokens * ((:now - r.created_at) / 86400)) / :days_double_tokens
+                END + r.additional_tokens AS token_reward
+            FROM request r
+            JOIN base b ON b.list = r.list AND b.type = r.type
+            WHERE r.state = :open
+            ORDER BY token_reward DESC, r.created_at
+            LIMIT :max_requests
+            """
+        data = {"now":int(time.time()), "days_double_tokens":self.days_double_tokens, "open":RequestState.OPEN.value, "max_requests":max_requests}
+        return await db.fetchall(query,data)
 
+    async def calculate_request_tokens(self, db, thread_id):
         query_request = """
-                    SELECT r.list,r.type,r.additional_tokens
+                    SELECT r.list,r.type,r.additional_tokens,r.created_at
                     FROM request r
                     WHERE r.thread_id = ?
                     """
-        res = cur.execute(query_request,(thread_id,))
-        (list_option_id,request_type_id,additional_tokens) = res.fetchone()
-        list_option = RequestList(list_option_id)
-        request_type = RequestType(request_type_id)
-        channel_obj = await self.server_obj.fetch_channel(thread_id)
-        creation_date = channel_obj.created_at                                
-        if list_option == RequestList.OPEN:
-            # Always 1 token for all requests in open list
-            token_reward = self.calculate_cumulative_tokens(1,creation_date)+additional_tokens
-        elif list_option == RequestList.CRITIC:
-            token_reward = self.calculate_cumulative_tokens(self.critic_list_token_rewards[request_type.value - 1],creation_date)+additional_tokens
-        elif list_option == RequestList.TRUSTED_CRITIC:
-            token_reward = self.calculate_cumulative_tokens(self.trusted_critic_list_token_rewards[request_type.value - 1],creation_date)+additional_tokens
-
-        return token_reward
+        (list_option_id,request_type_id,additional_tokens,created_at) = await db.fetchone(query_request,(thread_id,))
+        return self.request_token_reward(RequestList(list_option_id),RequestType(request_type_id),additional_tokens,created_at)
+
+    # Thread events are not processed immediately, to give the author time to apply tags and post the starter message.
+    # Instead they are queued and processed after react_sleep seconds without blocking the event loop.
+    # Only the latest event for each thread is kept, and all threads that become due together are processed concurrently.
+    def defer_thread(self, thread: discord.Thread, handler):
+        # A thread deleted before its creation was processed never became a request, so neither event needs processing.
+        pending = self.pending_threads.get(thread.id)
+        if not pending is None and pending[2] == self.process_thread and handler == self.process_thread_deleted:
+            del self.pending_threads[thread.id]
+            return
+
+        due = time.monotonic() + self.react_sleep
+        self.pending_threads[thread.id] = (due, thread, handler)
+
+        if self.pending_threads_task is None or self.pending_threads_task.done():
+            self.pending_threads_task = asyncio.create_task(self.process_pending_threads())
+
+    async def process_pending_threads(self):
+        while len(self.pending_threads) > 0:
+            next_due = min(due for (due, thread, handler) in self.pending_threads.values())
+            await asyncio.sleep(max(0, next_due - time.monotonic()))
+
+            now = time.monotonic()
+            due_thread_ids = [thread_id for (thread_id, (due, thread, handler)) in self.pending_threads.items() if due <= now]
+            batch = [self.pending_threads.pop(thread_id) for thread_id in due_thread_ids]
+
+            # We do not wait for the batch to finish, so that threads due later are not delayed by it.
+            task = asyncio.create_task(self.process_thread_batch(batch))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    async def process_thread_batch(self, batch):
+        results = await asyncio.gather(*(handler(thread) for (due, thread, handler) in batch), return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Uncaught exception when processing a thread event: {result}")
 
     async def process_thread(self, thread: discord.Thread):        
-        if thread.parent_id == self.open_list_channel_id:
-            await self.newopenrequest(thread)
-        elif thread.parent_id == self.critic_list_channel_id:
-            await self.newcriticrequest(thread)
-        elif thread.parent_id == self.trusted_critic_list_channel_id:
-            await self.newtrustedcriticrequest(thread)
+        if thread.parent_id in self.list_channels:
+            await self.intake_request(thread, self.list_channels[thread.parent_id])
 
     async def process_thread_deleted(self, thread: discord.Thread):        
-        if thread.parent_id == self.open_list_channel_id:
-            await self.deleterequest(thread)
-        elif thread.parent_id == self.critic_list_channel_id:
-            await self.deleterequest(thread)
-        elif thread.parent_id == self.trusted_critic_list_channel_id:
+        if thread.parent_id in self.list_channels:
             await self.deleterequest(thread)
 
     async def process_message(self, message: discord.Message):        
@@ -625,23 +802,28 @@ class CriticsGuildButler(discord.Client):
     ###
     # Interaction support methods
     ###
-    async def send_channel(self, channel: discord.TextChannel, content = None, embeds = None, mentions = True, **kwargs):
-        if not mentions:               
-            await channel.send(content=content, embeds=embeds, allowed_mentions=discord.AllowedMentions(users=[]), **kwargs)
-        else:
-            await channel.send(content=content, embeds=embeds, **kwargs)
+    # Queues a message to be sent by the outbound queue. Returns the sent message, or None right away if wait is False.
+    # Plain text messages (no embeds, views or files) to the same place and with the same mentions setting may be merged into one.
+    async def send_queued(self, send, route, content, embeds, mentions, priority=Priority.HIGH, wait=True, **kwargs):
+        if not mentions:
+            kwargs["allowed_mentions"] = discord.AllowedMentions(users=[])
+
+        merge_key = None
+        if not content is None and embeds is None and all(key == "allowed_mentions" for key in kwargs):
+            merge_key = (route, mentions)
+
+        future = self.outbound.put(route, lambda content: send(content=content, embeds=embeds, **kwargs), content, priority, merge_key, wait)
+        if wait:
+            return await future
+
+    async def send_channel(self, channel: discord.TextChannel, content = None, embeds = None, mentions = True, priority=Priority.HIGH, wait=True, **kwargs):
+        return await self.send_queued(channel.send, channel.id, content, embeds, mentions, priority, wait, **kwargs)
         
     async def send_dm(self, user: discord.User, content = None, embeds = None, mentions = False, **kwargs):
-        if not mentions:
-            await user.send(content=content, embeds=embeds, allowed_mentions=discord.AllowedMentions(users=[]), **kwargs)
-        else:
-            await user.send(content=content, embeds=embeds, **kwargs)
+        await self.send_queued(user.send, ("dm", user.id), content, embeds, mentions, **kwargs)
 
     async def send_thread(self, thread: discord.Thread, content = None, embeds = None, mentions = True, **kwargs):
-        if not mentions:
-            await thread.send(content=content, embeds=embeds, allowed_mentions=discord.AllowedMentions(users=[]), **kwargs)
-        else:
-            await thread.send(content=content, embeds=embeds, **kwargs)
+        await self.send_queued(thread.send, thread.id, content, embeds, mentions, **kwargs)
 
     async def defer(self, interaction):
         await interaction.response.defer(ephemeral=True)
@@ -652,11 +834,25 @@ class CriticsGuildButler(discord.Client):
         else:
             await interaction.followup.send(content=content, ephemeral=True, **kwargs)
 
+    # Replies are never merged, since they refer to a specific message.
     async def send_reply(self, message: discord.Message, content = None, embeds = None, mentions = True, **kwargs):
         if not mentions:
-            await message.reply(content=content, embeds=embeds, allowed_mentions=discord.AllowedMentions(users=[]), **kwargs)
-        else:
-            await message.reply(content=content, embeds=embeds, **kwargs)
+            kwargs["allowed_mentions"] = discord.AllowedMentions(users=[])
+
+        await self.outbound.send(message.channel.id, lambda content: message.reply(content=content, embeds=embeds, **kwargs), content)
+
+    # Runs independent steps of a command concurrently. steps are (description, coroutine) pairs.
+    # A failing step does not stop the others: each failure is logged as "Could not <description>", and the failures are returned by description.
+    async def fan_out(self, db, steps, cause_id=None):
+        results = await asyncio.gather(*(coroutine for (description, coroutine) in steps), return_exceptions=True)
+
+        failures = {}
+        for ((description, coroutine), result) in zip(steps, results):
+            if isinstance(result, Exception):
+                failures[description] = result
+                await self.log_system(db, f"Could not {description}: {result}", cause_id=cause_id)
+
+        return failures
 
     async def check_admin_channel(self, interaction: discord.Interaction):
         if interaction.channel_id != self.log_channel_id:
@@ -667,7 +863,7 @@ class CriticsGuildButler(discord.Client):
             return True
 
     async def send_admin_channel(self, content = None, embeds = None, mentions = False, **kwargs):
-        return await self.send_channel(self.log_channel_obj, content, embeds, mentions, **kwargs)    
+        return await self.send_channel(self.log_channel_obj, content, embeds, mentions, **kwargs)
     
     async def check_critic(self, db, interaction: discord.Interaction, command_name, request_id = None, cause_id = None, **kwargs):
         if not any((role.id == self.trusted_critic_role_id or role.id == self.critic_role_id) for role in interaction.user.roles):
@@ -689,7 +885,7 @@ class CriticsGuildButler(discord.Client):
 
     async def check_request_owner(self, db, interaction: discord.Interaction, command_name, cause_id = None, **kwargs):
         thread_id = interaction.channel_id
-        channel_obj = await self.server_obj.fetch_channel(thread_id)
+        channel_obj = await self.lookup_channel(thread_id)
 
         user_mention = self.mention_user(interaction.user.id)
 
@@ -698,21 +894,18 @@ class CriticsGuildButler(discord.Client):
             await self.send_response(interaction, "This command can only be run in a Critic's Guild request you created.")
             return False
 
-        if not check_request(db, thread_id):
+        if not await db.run(check_request,thread_id):
             await self.log_error(db, f"{user_mention} tried to run `{command_name}` in a thread not present in the database.",interaction.user.id,cause_id=cause_id)
             await self.send_response(interaction, "This command can only be run in a Critic's Guild request you created.")
             return False
         
-        cur = db.cursor()
-
         if not any(role.id == self.trusted_critic_role_id for role in interaction.user.roles):
             query_owner = """
                 SELECT r.author_id
                 FROM request r
                 WHERE r.thread_id = ?
                 """
-            res = cur.execute(query_owner,(thread_id,))
-            author_id = res.fetchone()[0]
+            author_id = (await db.fetchone(query_owner,(thread_id,)))[0]
 
             if author_id != interaction.user.id:
                 await self.log_error(db, f"{user_mention} tried to run `{command_name}` in a request they did not author.",interaction.user.id,cause_id=cause_id)
@@ -722,18 +915,18 @@ class CriticsGuildButler(discord.Client):
         return True
 
     async def do_close_request(self, db, interaction: discord.Interaction, user_mention, channel_obj, command_id):
-        cur = db.cursor()        
-
         thread_id = interaction.channel_id
 
         # Change state.
         query_update = """
             UPDATE request
-            SET state = :closed_state
+            SET state = :closed_state, closed_at = :closed_at
             WHERE thread_id = :thread_id
+            RETURNING author_id
             """
-        data = {"closed_state":RequestState.COMPLETED.value,"thread_id":thread_id}
-        res = cur.execute(query_update,data)                                               
+        data = {"closed_state":RequestState.COMPLETED.value,"closed_at":int(time.time()),"thread_id":thread_id}
+        (author_id,) = await db.fetchone(query_update,data)
+        self.user_cache.invalidate(author_id)                                               
        
         try:
             await self.send_thread(channel_obj, f"✅{user_mention} closed this request.",mentions=False)
@@ -747,109 +940,85 @@ class CriticsGuildButler(discord.Client):
                 
         await self.log_result(db,f"{user_mention} closed {channel_obj.jump_url}",interaction.user.id,request_id=thread_id,cause_id=command_id)
 
-    async def do_critic_upvote_leaderboard(self, db, channel_id, max_critics:int = 5, historic: bool = False):
-        cur = db.cursor()
+    def page_embed(self, title, pages, page):
+        embed = discord.Embed(title=title, description=pages[page] if pages else "Nothing to show.")
+        if len(pages) > 1:
+            embed.set_footer(text=f"Page {page+1}/{len(pages)}")
+        return embed
+
+    # Sends pages of text as a single embed message, with buttons to move between them if there is more than one.
+    async def send_pages(self, channel_obj, title, pages):
+        if len(pages) > 1:
+            view = self.EmbedPages(self,title,pages)
+            view.message = await self.send_channel(channel_obj, embeds=[self.page_embed(title,pages,0)], view=view)
+        else:
+            await self.send_channel(channel_obj, embeds=[self.page_embed(title,pages,0)])
 
-        channel_obj = await self.server_obj.fetch_channel(channel_id)
+    # Sends a whole leaderboard as a single embed message, split into pages of leaderboard_page_size lines.
+    async def send_leaderboard(self, channel_obj, title, lines):
+        pages = ["\n".join(lines[i:i+self.leaderboard_page_size]) for i in range(0, len(lines), self.leaderboard_page_size)]
+        await self.send_pages(channel_obj, title, pages)
 
-        if historic:
-            query = """
-                SELECT
-                    u.user_id,
-                    u.critic_upvotes,
-                    u.historic_critic_upvotes
-                FROM user u
-                ORDER BY u.historic_critic_upvotes DESC
-                LIMIT :max_critics
-                """
+    # Log queries reaching further back than the archive horizon also read the archived entries.
+    def log_table(self, days):
+        if days > self.log_archive_days:
+            return "all_log"
         else:
-            query = """
-                SELECT
-                    u.user_id,
-                    u.critic_upvotes,
-                    u.historic_critic_upvotes
-                FROM user u
-                ORDER BY u.critic_upvotes DESC
-                LIMIT :max_critics
-                """
-                
-        data = {"max_critics":max_critics}
-        res = cur.execute(query,data)
-        critics = res.fetchall()                                
-                                
-        await self.send_channel(channel_obj, f"👍TOP {max_critics} critics by upvotes👍")
+            return "log"
 
-        i = 0
-        for critic in critics:
-            i += 1
-            (user_id, critic_upvotes, historic_critic_upvotes) = critic
-            critic_mention = self.mention_user(user_id)
-            await self.send_channel(channel_obj, f"{i} - {critic_mention} - {self.upvotes(critic_upvotes)}", mentions = False)
+    # Sends the given log entries to the admin channel as a paginated embed, each preceded by its causes and followed by
+    # its consequences if with_tree, indented by their depth in the causal tree.
+    async def send_log_trees(self, db, title, log_ids, with_tree, archived = False, show_requests = True):
+        rows = await db.run(fetch_log_trees, log_ids, with_tree, archived)
 
-        await self.send_channel(channel_obj, self.horizontal_separator())
+        # Causes have negative depths, so each tree is shifted to start at no indentation.
+        min_depths = {}
+        for (root_id, depth, *entry) in rows:
+            min_depths[root_id] = min(depth, min_depths.get(root_id, 0))
 
-    async def do_token_leaderboard(self, db, channel_id, max_users:int = 5):
-        cur = db.cursor()
+        lines = []
+        for (root_id, depth, log_id, user_id, request_id, date_str, log_class_id, summary) in rows:
+            log_class = LogClass(log_class_id)
+            level = depth - min_depths[root_id]
 
-        channel_obj = await self.server_obj.fetch_channel(channel_id)
+            line = f"{self.get_class_icon(log_class)}{log_class.name}/{log_id} ({date_str}) - {summary}"
+            if show_requests and not request_id is None:
+                line += f" (on <#{request_id}>)"
+            if log_id == root_id:
+                line = f"**{line}**"
+            if level > 0:
+                line = "\u2003" * (level - 1) + "↳ " + line
 
-        query = """
-            SELECT
-                u.user_id,
-                u.tokens
-            FROM user u
-            ORDER BY u.tokens DESC
-            LIMIT :max_users
-            """
-                
-        data = {"max_users":max_users}
-        res = cur.execute(query,data)
-        users = res.fetchall()                                
-                                
-        await self.send_channel(channel_obj, f"🔹TOP {max_users} users by tokens🔹")
+            lines.append(line)
 
-        i = 0
-        for user in users:
-            i += 1
-            (user_id, user_tokens) = user
-            user_mention = self.mention_user(user_id)
-            await self.send_channel(channel_obj, f"{i} - {user_mention} - {self.tokens(user_tokens)}", mentions = False)
+        await self.send_pages(self.log_channel_obj, title, chunk_lines(lines, self.embed_page_limit))
 
-        await self.send_channel(channel_obj, self.horizontal_separator())
+    async def do_critic_upvote_leaderboard(self, db, channel_id, max_critics:int = 5, historic: bool = False):
+        channel_obj = await self.lookup_channel(channel_id)
 
-    async def do_wanted_requests(self, db, channel_id, max_requests:int = 10):                
-        cur = db.cursor()
+        if historic:
+            critics = self.rankings["historic_critic_upvotes"].top(max_critics)
+        else:
+            critics = self.rankings["critic_upvotes"].top(max_critics)
 
-        channel_obj = await self.server_obj.fetch_channel(channel_id)                        
+        lines = [f"{i} - {self.mention_user(user_id)} - {self.upvotes(self.rankings['critic_upvotes'].value(user_id))}" for (i, (user_id, value)) in enumerate(critics, 1)]
+        await self.send_leaderboard(channel_obj, f"👍TOP {max_critics} critics by upvotes👍", lines)
 
-        # We need to use log timestamps because we did not add creation date to the request table...
-        # Could add it in the future but would need to update existing stuff.
-        query = """
-            SELECT
-                r.thread_id,
-                r.author_id,
-                r.list,
-                r.critic_id,
-                r.type,
-                (SELECT MIN(l.timestamp) FROM log l WHERE l.request_id = r.thread_id) AS date
-            FROM request r
-            WHERE r.state IN (:open)
-            """
-        data = {"open": RequestState.OPEN.value}
-        res = cur.execute(query,data)
-        requests = res.fetchall()
-        
-        requests_with_tokens = [(thread_id,author_id,list_option_id,critic_id,type_id,date,await self.calculate_request_tokens(db,thread_id)) for (thread_id,author_id,list_option_id,critic_id,type_id,date) in requests]
-        
-        def by_tokens(request):
-            (thread_id,author_id,list_option_id,critic_id,type_id,date,token_reward) = request
-            return token_reward
+    async def do_token_leaderboard(self, db, channel_id, max_users:int = 5):
+        channel_obj = await self.lookup_channel(channel_id)
 
-        requests_with_tokens.sort(reverse=True,key=by_tokens)
-                
-        await self.send_channel(channel_obj, f"‼️WANTED‼️ - TOP ({max_requests}) requests by 🔹token reward")
+        users = self.rankings["tokens"].top(max_users)
+
+        lines = [f"{i} - {self.mention_user(user_id)} - {self.tokens(user_tokens)}" for (i, (user_id, user_tokens)) in enumerate(users, 1)]
+        await self.send_leaderboard(channel_obj, f"🔹TOP {max_users} users by tokens🔹", lines)
+
+    async def do_wanted_requests(self, db, channel_id, max_requests:int = 10):                
+        channel_obj = await self.lookup_channel(channel_id)                        
 
-        for (thread_id, author_id, list_option_id, critic_id, type_id, date, token_reward) in requests_with_tokens[:max_requests]:
+        requests = await self.top_request_rewards(db, max_requests)
+
+        lines = []
+        for (thread_id, author_id, list_option_id, critic_id, type_id, created_at, token_reward) in requests:
             list_option = RequestList(list_option_id)
             request_type = RequestType(type_id)
                         
@@ -862,27 +1031,38 @@ class CriticsGuildButler(discord.Client):
 
             author_mention = self.mention_user(author_id)                    
 
-            request_mention = await self.display_request(thread_id)
+            request_mention = self.mention_request(thread_id)
 
-            date = datetime.datetime.fromisoformat(date)                   
-                                
-            delta_creation = datetime.datetime.now() - date
-            days_since_creation = delta_creation.days
+            days_since_creation = self.days_since(created_at)
 
-            await self.send_channel(channel_obj, f"{self.tokens(token_reward)} - {request_mention} by {author_mention} - {days_since_creation} days old {list_str}.\n", mentions = False)
+            lines.append(f"{self.tokens(token_reward)} - {request_mention} by {author_mention} - {days_since_creation} days old {list_str}.")
 
-        await self.send_channel(channel_obj, self.horizontal_separator())
+        await self.send_leaderboard(channel_obj, f"‼️WANTED‼️ - TOP ({max_requests}) requests by 🔹token reward", lines)
 
-    async def do_token_cycle(self, db):
-        cur = db.cursor()
+    # Moves log entries older than log_archive_days to the archive database, one batch per worker call so other work can run in between.
+    async def do_log_archival(self, db):
+        cutoff = int(time.time()) - self.log_archive_days*86400
+
+        archived = 0
+        while True:
+            n = await db.run(archive_log_batch, cutoff)
+            if n == 0:
+                break
+            archived += n
 
+        if archived > 0:
+            await self.log_system(db, f"Log archival: {archived} log entries older than {self.log_archive_days} days were moved to the archive.")
+
+    async def do_token_cycle(self, db):
         query = """
             UPDATE user
             SET claimed_tokens = 0, tokens = CAST(tokens * :decay AS INTEGER) + (tokens * :decay > CAST(tokens * :decay AS INTEGER))
             """
                 
         data = {"decay":self.token_decay}
-        cur.execute(query,data) 
+        await db.execute(query,data) 
+        self.user_cache.clear()
+        await db.run(load_rankings, {"tokens":self.rankings["tokens"]})
 
         await self.log_system(db, f"Automatic token cycle: Claims have been reset and token decay has been applied")
         
@@ -890,36 +1070,60 @@ class CriticsGuildButler(discord.Client):
     # Logging
     ###
 
+    async def log_write_error(self, e):
+        await self.send_admin_channel(content=f"IMPORTANT!! There was an error when trying to write log messages into the database. Please check.")
+
+    def outbound_summary(self):
+        return f"Outbound messages: {len(self.outbound)} waiting, {self.outbound.sent} sent, {self.outbound.merged} merged into others"
+
+    def log_writer_summary(self):
+        return f"Log writer: {len(self.log_writer.entries)} entries waiting, {len(self.log_writer.dead_letters)} entries dropped"
+
+    async def scheduled_task_error(self, name, e):
+        db = self.db_connect()
+        await self.log_system(db, f"UNCAUGHT EXCEPTION in scheduled task {name}! - {str(e)}")
+        db.close()
+
     # Returns the log id
     async def log(self, db, summary: str, user_id, request_id, log_class, cause_id, **kwargs):
 
-        try:
-            cursor = db.cursor()
-
-            if not user_id is None:
-                check_user(db, user_id)            
+        # The log line is still output, without an id, if the entry cannot be written.
+        log_id = None
+        timestamp = int(time.time())
 
+        try:
             if not request_id is None:
-                if not check_request(db, request_id):
+                if not await db.run(check_request,request_id):
                     await self.log_system(db, f"Attempt to write log entry with request_id not present in the database: {request_id}",cause_id=None)
                     request_id = None
 
-            timestamp = datetime.datetime.now(tz = None)
-
-            cursor.execute("INSERT INTO log (user_id, request_id, timestamp, class, cause_id, summary) VALUES (?,?,?,?,?,?)",(user_id, request_id, timestamp, log_class.value, cause_id, summary))
-            log_id = cursor.lastrowid
+            # The entry (and the user, if new) is written to the database shortly after, together with other entries.
+            log_id = await self.log_writer.write(user_id, request_id, timestamp, log_class.value, cause_id, summary)
         except sqlite3.Error as e:
             print(f"SQLite error when trying to insert into the database!!: {e}")
             await self.send_admin_channel(content=f"IMPORTANT!! There was an error when trying to write the log message into the database. Please check.")            
 
+        if len(kwargs) == 0:
+            self.log_output(log_id, log_class, summary, timestamp)
+        else:
+            # Anything with extra message options is sent on its own rather than merged with other log lines.
+            message = f"{self.get_class_icon(log_class)}{log_class.name}/{log_id} - {summary}"
+            await self.send_admin_channel(content=message,priority=Priority.LOW,wait=False,**kwargs)
+
+            if self.print_log:
+                print(f"{datetime.datetime.fromtimestamp(timestamp)} - {message}")
+
+        return log_id
+
+    # Log lines are sent to the log channel in the background, in the low priority lane, merged with other log lines.
+    def log_output(self, log_id, log_class, summary, timestamp):
         message = f"{self.get_class_icon(log_class)}{log_class.name}/{log_id} - {summary}"
 
-        await self.send_admin_channel(content=message,**kwargs)
+        for chunk in chunk_lines([message]):
+            self.outbound.put(self.log_channel_id, lambda content: self.log_channel_obj.send(content=content, allowed_mentions=discord.AllowedMentions(users=[])), chunk, Priority.LOW, (self.log_channel_id, False), wait=False)
 
         if self.print_log:
-            print(f"{timestamp} - {message}")
-
-        return log_id
+            print(f"{datetime.datetime.fromtimestamp(timestamp)} - {message}")
 
     async def log_system(self, db, summary: str, cause_id=None, **kwargs):
         return await self.log(db,summary,user_id=None,request_id=None,log_class=LogClass.SYSTEM,cause_id=cause_id,**kwargs)
@@ -933,405 +1137,178 @@ class CriticsGuildButler(discord.Client):
     async def log_error(self, db, summary: str, user_id, request_id=None, cause_id=None, **kwargs):
         return await self.log(db, summary,user_id=user_id,request_id=request_id,log_class=LogClass.ERROR,cause_id=cause_id,**kwargs)
     
-    async def log_tokens(self, db, user_id, previous_tokens, new_tokens, request_id=None, cause_id=None, **kwargs):
-        user_mention = self.mention_user(user_id)
-        return await self.log_result(db,f"{user_mention} went from {self.tokens(previous_tokens)} to {self.tokens(new_tokens)}.",user_id,request_id,cause_id,**kwargs)
-
-    async def log_mapper_upvotes(self, db, user_id, previous_upvotes, new_upvotes, request_id=None, cause_id=None, **kwargs):
-        user_mention = self.mention_user(user_id)
-        return await self.log_result(db,f"{user_mention} went from {self.upvotes(previous_upvotes)} to {self.upvotes(new_upvotes)} (mapper).",user_id,request_id,cause_id,**kwargs)
-
-    async def log_critic_upvotes(self, db, user_id, previous_upvotes, new_upvotes, request_id=None, cause_id=None, **kwargs):
-        user_mention = self.mention_user(user_id)
-        return await self.log_result(db,f"{user_mention} went from {self.upvotes(previous_upvotes)} to {self.upvotes(new_upvotes)} (critic).",user_id,request_id,cause_id,**kwargs)
-
-    async def log_stars(self, db, user_id, previous_stars, new_stars, request_id=None, cause_id=None, **kwargs):
-        user_mention = self.mention_user(user_id)
-        return await self.log_result(db,f"{user_mention} went from {self.stars(previous_stars)} to {self.stars(new_stars)}.",user_id,request_id,cause_id,**kwargs)
-
-    async def log_penalties(self, db, user_id, previous_penalties, new_penalties, request_id=None, cause_id=None, **kwargs):
-        user_mention = self.mention_user(user_id)
-        return await self.log_result(db,f"{user_mention} went from {self.penalties(previous_penalties)} to {self.penalties(new_penalties)}.",user_id,request_id,cause_id,**kwargs)
-
     ###
     # Periodic tasks
     ###
-    @tasks.loop(hours=1)
+    # Run by the scheduler, see __init__ for when.
     async def show_leaderboards(self):
         db = self.db_connect()
 
-        now = datetime.datetime.utcnow()
-        if now.weekday() == self.leaderboard_task_weekday and now.hour == self.leaderboard_task_hour:
-            await self.log_system(db, f"Displaying weekly leaderboards")
-            await self.do_critic_upvote_leaderboard(db, self.publish_channel_id)
-            await self.do_token_leaderboard(db, self.publish_channel_id)
-            await self.do_wanted_requests(db, self.publish_channel_id)
-        else:
-            #await self.log_system(db, f"No tasks to run...")        
-            pass
+        await self.log_system(db, f"Displaying weekly leaderboards")
+        await self.do_critic_upvote_leaderboard(db, self.publish_channel_id)
+        await self.do_token_leaderboard(db, self.publish_channel_id)
+        await self.do_wanted_requests(db, self.publish_channel_id)
 
         db.close()
 
-    @tasks.loop(hours=1)
     async def token_cycle(self):
         db = self.db_connect()
 
-        now = datetime.datetime.utcnow()
-        if now.day == self.token_cycle_task_monthday and now.hour == self.token_cycle_task_hour:
-            await self.do_token_cycle(db)
-        else:
-            #await self.log_system(db, f"No tasks to run...")        
-            pass
+        await self.do_token_cycle(db)
+
+        db.close()
+
+    async def log_archival(self):
+        db = self.db_connect()
+
+        await self.do_log_archival(db)
 
         db.close()
 
     ###
     # Reactions to events
     ###
-    async def newopenrequest(self, thread: discord.Thread):
-        time.sleep(self.react_sleep)
+    # Takes in a new request thread on any of the lists, as configured in intake_lists. The stages are timed, see record_intake_stage.
+    async def intake_request(self, thread: discord.Thread, list_option: RequestList):
+        (list_name, responders, token_costs, token_rewards) = self.intake_lists[list_option]
 
         db = self.db_connect()
 
+        stage_started = time.perf_counter()
+        def end_stage(stage):
+            nonlocal stage_started
+            now = time.perf_counter()
+            self.record_intake_stage(stage, now - stage_started)
+            stage_started = now
+
         try:
             user_mention = self.mention_user(thread.owner_id)
             request_title = thread.name
-            command_id = await self.log_command(db,f"{user_mention} created request {thread.jump_url} in the open list.",thread.owner_id)
+            command_id = await self.log_command(db,f"{user_mention} created request {thread.jump_url} in the {list_name}.",thread.owner_id)
             
-            check_user(db,thread.owner_id)
-
-            cur = db.cursor()
-
-            # Check exactly one tag
-            n_tags = len(thread.applied_tags)
-            if n_tags != 1:
-                await self.log_error(db,f"{user_mention} tried to create a new request with {n_tags} tags applied to it.",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because it had {n_tags} tags applied to it. Requests must have exactly 1 tag to be valid, indicating the type of request they are.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to excessive tags: {e}", cause_id = command_id)
-                await thread.delete()
-                db.close()
-                return
-
-            # Check it has attachment - This is not a requirement but if it does not it is noted on the bot's message.
-            if not thread.last_message_id is None:
-                message = await thread.fetch_message(thread.last_message_id)
-                has_attachment = (len(message.attachments) > 0)
-            else:
-                await self.log_system(db,f"Couldn't fetch the last message on a thread.",cause_id=command_id)
-                has_attachment = True
-
-            # No token requirement
-
-            # Check number of penalties
-            query_penalties = """
-                SELECT u.penalties
-                FROM user u
-                WHERE u.user_id = ?
-                """
-            res = cur.execute(query_penalties,(thread.owner_id,))
-            penalties = res.fetchone()[0]
-
-            if penalties >= self.max_penalties:
-                await self.log_error(db,f"{user_mention} tried to create a new request but they have {self.penalties(penalties)}",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you have {self.penalties(penalties)}. You are not allowed to create requests with these many penalties. If you would like to have penalties removed, contact Staff to understand the reason you received them.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to penalties: {e}", cause_id = command_id)
-                await thread.delete()
-                db.close()
-                return
+            # Tokens, penalties and active requests all come from a single query, or from the cache.
+            user_state = await self.get_user_state(db,thread.owner_id)
+            end_stage("state")
 
-            # Check number of active requests
-            query_active = """
-                SELECT
-                    COUNT(*)
-                FROM request r
-                WHERE r.author_id = :user_id
-                    AND r.state IN (:open_state,:claimed_state)
-                """
-            data = {"user_id":thread.owner_id, "open_state":RequestState.OPEN.value,"claimed_state":RequestState.CLAIMED.value}
-            res = cur.execute(query_active,data)
-            requests = res.fetchone()[0]
-            
-            if requests >= self.max_requests:
-                await self.log_error(db,f"{user_mention} tried to create a new request but they already have {requests} requests open.",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
+            async def reject(log_summary, dm_content, dm_failure):
+                await self.log_error(db,log_summary,thread.owner_id,cause_id=command_id)
+                user = await self.lookup_member(thread.owner_id)
                 try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you already have {requests} requests open. You may not have more than {self.max_requests} requests open at any one time (across all lists). Please wait until one of your requests is completed or cancel an unclaimed request.")
+                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because {dm_content}")
                 except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to too many active requests: {e}", cause_id = command_id)
+                    await self.log_system(db, f"Could not send DM informing user of deleted request due to {dm_failure}: {e}", cause_id = command_id)
                 await thread.delete()
-                db.close()
-                return    
-
-            # Create the request
-            thread_id = await self.create_request(db,thread,cause_id=command_id)
-            
-            # Make a post in the request with basic info.
-            try:
-                await self.send_thread(thread, f"✅The {thread.applied_tags[0].emoji.name}**{thread.applied_tags[0].name}** request has been registered. {user_mention} now has {requests+1}/{self.max_requests} active requests.",mentions=False)
-                await self.send_thread(thread, f"Responding to this request will reward {self.tokens(1)}. {user_mention} may increase the token reward using `/addtokens`.",mentions=False)
-                await self.send_thread(thread, f"Possible actions for {user_mention}:\n- ✅Accept response and give reward - `/thanksforfeedback`\n- ✅Close request as finished - `/closerequest`\n- ❌Cancel the request (no responses) - `/cancelrequest`",mentions=False)
-            except Forbidden as e:
-                await self.log_system(db, f"Could not send messages in thread: {e}", cause_id = command_id)
-            #if not has_attachment:
-            #    await self.send_thread(thread,f"⚠️No attachment was detected on the original message. If this is a mistake, please remember to attach your map file now. Ignore if attachment isn't necessary.",mentions=False)
-
-        except Exception as e:                
-            await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
-            
-        db.close()
-
-    async def newcriticrequest(self, thread: discord.Thread):
-        time.sleep(self.react_sleep)
-
-        db = self.db_connect()
-
-        try:
-            user_mention = self.mention_user(thread.owner_id)
-            request_title = thread.name
-            command_id = await self.log_command(db,f"{user_mention} created request {thread.jump_url} in the critics list.",thread.owner_id)
-            
-            check_user(db,thread.owner_id)
-
-            cur = db.cursor()
+                end_stage("reject")
 
             # Check exactly one tag
             n_tags = len(thread.applied_tags)
             if n_tags != 1:
-                await self.log_error(db,f"{user_mention} tried to create a new request with {n_tags} tags applied to it.",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because it had {n_tags} tags applied to it. Requests must have exactly 1 tag to be valid, indicating the type of request they are.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to excessive tags: {e}", cause_id = command_id)
-                await thread.delete()
+                await reject(f"{user_mention} tried to create a new request with {n_tags} tags applied to it.",
+                             f"it had {n_tags} tags applied to it. Requests must have exactly 1 tag to be valid, indicating the type of request they are.",
+                             "excessive tags")
                 db.close()
                 return
 
-            # Check it has attachment - This is not a requirement but if it does not it is noted on the bot's message.
-            if not thread.last_message_id is None:
-                message = await thread.fetch_message(thread.last_message_id)
-                has_attachment = (len(message.attachments) > 0)
-            else:
-                await self.log_system(db,f"Couldn't fetch the last message on a thread.",cause_id=command_id)
-                has_attachment = True
-
-            # Check number of penalties         
-            query_tokens_penalties = """
-                SELECT u.tokens, u.penalties
-                FROM user u
-                WHERE u.user_id = ?
-                """
-            res = cur.execute(query_tokens_penalties,(thread.owner_id,))
-            (tokens,penalties) = res.fetchone()
-
-            if penalties >= self.max_penalties:
-                await self.log_error(db,f"{user_mention} tried to create a new request but they have {self.penalties(penalties)}",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you have {self.penalties(penalties)}. You are not allowed to create requests with these many penalties. If you would like to have penalties removed, contact Staff to understand the reason you received them.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to penalties: {e}", cause_id = command_id)
-                await thread.delete()
+            kind = await self.get_request_kind(db,thread,cause_id=command_id)
+            if kind is None:
                 db.close()
                 return
-
-            # Check number of active requests
-            query_active = """
-                SELECT
-                    COUNT(*)
-                FROM request r
-                WHERE r.author_id = :user_id
-                    AND r.state IN (:open_state,:claimed_state)
-                """
-            data = {"user_id":thread.owner_id, "open_state":RequestState.OPEN.value,"claimed_state":RequestState.CLAIMED.value}
-            res = cur.execute(query_active,data)
-            requests = res.fetchone()[0]
-            
-            if requests >= self.max_requests:
-                await self.log_error(db,f"{user_mention} tried to create a new request but they already have {requests} requests open.",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you already have {requests} requests open. You may not have more than {self.max_requests} requests open at any one time (across all lists). Please wait until one of your requests is completed or cancel an unclaimed request.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to too many active requests: {e}", cause_id = command_id)
-                await thread.delete()
+            (list_option, request_type, token_cost, token_reward) = kind
+
+            # Returns the arguments to reject the request with given the state of the author, or None if they may create it.
+            def check_limits(user_state):
+                # Check number of penalties
+                penalties = user_state["penalties"]
+                if penalties >= self.max_penalties:
+                    return (f"{user_mention} tried to create a new request but they have {self.penalties(penalties)}",
+                            f"you have {self.penalties(penalties)}. You are not allowed to create requests with these many penalties. If you would like to have penalties removed, contact Staff to understand the reason you received them.",
+                            "penalties")
+
+                # Check number of active requests
+                requests = user_state["active_requests"]
+                if requests >= self.max_requests:
+                    return (f"{user_mention} tried to create a new request but they already have {requests} requests open.",
+                            f"you already have {requests} requests open. You may not have more than {self.max_requests} requests open at any one time (across all lists). Please wait until one of your requests is completed or cancel an unclaimed request.",
+                            "too many active requests")
+
+                # Tokens
+                tokens = user_state["tokens"]
+                if tokens < token_cost:
+                    return (f"{user_mention} tried to create a new request of type {request_type} but they only have {self.tokens(tokens)} and require {self.tokens(token_cost)}",
+                            f"you only have {self.tokens(tokens)} and require {self.tokens(token_cost)} to create a request of this type in the {list_name}.",
+                            "insufficient tokens")
+
+                return None
+
+            rejection = check_limits(user_state)
+            if not rejection is None:
+                await reject(*rejection)
                 db.close()
-                return    
-
-            # Tokens
-            (list_option, request_type) = await self.get_request_type(db,thread)
-            # Here we assume this is the critics list.
-            token_cost = self.critic_list_token_costs[request_type.value - 1]
-            token_reward = self.critic_list_token_rewards[request_type.value - 1]
-            if tokens < token_cost:
-                await self.log_error(db,f"{user_mention} tried to create a new request of type {request_type} but they only have {self.tokens(tokens)} and require {self.tokens(token_cost)}",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id) 
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you only have {self.tokens(tokens)} and require {self.tokens(token_cost)} to create a request of this type in the critics list.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to insufficient tokens: {e}", cause_id = command_id)
-                await thread.delete()
+                return
+            end_stage("validate")
+            
+            # Create the request. The tokens and active requests are checked again when it is inserted, since threads are processed
+            # concurrently and another request by the same author may have been created since the checks above.
+            active_requests = await self.create_request(db,thread,cause_id=command_id,kind=kind,max_requests=self.max_requests)
+            if active_requests is None:
+                self.user_cache.invalidate(thread.owner_id)
+                rejection = check_limits(await self.get_user_state(db,thread.owner_id))
+                if rejection is None:
+                    rejection = (f"{user_mention} tried to create a new request but it could not be created.",
+                                 f"it could not be created. Please try again.",
+                                 "failed creation")
+                await reject(*rejection)
                 db.close()
                 return
-            def token_update(previous):
-                return previous - token_cost
-            
-            # Create the request
-            thread_id = await self.create_request(db,thread,cause_id=command_id)
-            await self.update_tokens(db,thread.owner_id,token_update,request_id=thread_id,cause_id=command_id)
+            # The count this request was committed with, not whatever the count is by now.
+            (previous_requests, requests) = active_requests
+            end_stage("create")
             
             # Make a post in the request with basic info.
+            tag = thread.applied_tags[0]
+            consumed_str = "" if token_costs is None else f"{user_mention} consumed {self.tokens(token_cost)}. "
+            responders_str = "" if responders is None else f"Only {responders} may respond to requests in this list. "
             try:
-                await self.send_thread(thread, f"✅The {thread.applied_tags[0].emoji.name}**{thread.applied_tags[0].name}** request has been registered. {user_mention} consumed {self.tokens(token_cost)}. {user_mention} now has {requests+1}/{self.max_requests} active requests.",mentions=False)
-                await self.send_thread(thread, f"Only critics may respond to requests in this list. Responding to this request will reward {self.tokens(token_reward)}. {user_mention} may increase the token reward using `/addtokens`.",mentions=False)
-                await self.send_thread(thread, f"Possible actions for {user_mention}:\n- ✅Accept response and give reward - `/thanksforfeedback`\n- ✅Close request as finished - `/closerequest`\n- ❌Cancel the request (no responses) - `/cancelrequest`",mentions=False)
+                # Queued together, so they are merged into a single message.
+                await asyncio.gather(
+                    self.send_thread(thread, f"✅The {tag.emoji.name}**{tag.name}** request has been registered. {consumed_str}{user_mention} now has {requests}/{self.max_requests} active requests.",mentions=False),
+                    self.send_thread(thread, f"{responders_str}Responding to this request will reward {self.tokens(token_reward)}. {user_mention} may increase the token reward using `/addtokens`.",mentions=False),
+                    self.send_thread(thread, f"Possible actions for {user_mention}:\n- ✅Accept response and give reward - `/thanksforfeedback`\n- ✅Close request as finished - `/closerequest`\n- ❌Cancel the request (no responses) - `/cancelrequest`",mentions=False))
             except Forbidden as e:
                 await self.log_system(db, f"Could not send messages in thread: {e}", cause_id = command_id)
-            #if not has_attachment:
-            #    await self.send_thread(thread,f"⚠️No attachment was detected on the original message. If this is a mistake, please remember to attach your map file now. Ignore if attachment isn't necessary.",mentions=False)
+            end_stage("announce")
 
         except Exception as e:                
             await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
             
         db.close()
 
-    async def newtrustedcriticrequest(self, thread: discord.Thread):
-        time.sleep(self.react_sleep)
-
-        db = self.db_connect()
-
-        try:
-            user_mention = self.mention_user(thread.owner_id)
-            request_title = thread.name
-            command_id = await self.log_command(db,f"{user_mention} created request {thread.jump_url} in the trusted critics list.",thread.owner_id)
-            
-            check_user(db,thread.owner_id)
-
-            cur = db.cursor()
-
-            # Check exactly one tag
-            n_tags = len(thread.applied_tags)
-            if n_tags != 1:
-                await self.log_error(db,f"{user_mention} tried to create a new request with {n_tags} tags applied to it.",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because it had {n_tags} tags applied to it. Requests must have exactly 1 tag to be valid, indicating the type of request they are.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to excessive tags: {e}", cause_id = command_id)
-                await thread.delete()
-                db.close()
-                return
-
-            # Check it has attachment - This is not a requirement but if it does not it is noted on the bot's message.
-            if not thread.last_message_id is None:
-                message = await thread.fetch_message(thread.last_message_id)
-                has_attachment = (len(message.attachments) > 0)
-            else:
-                await self.log_system(db,f"Couldn't fetch the last message on a thread.",cause_id=command_id)
-                has_attachment = True
-
-            # Check number of penalties         
-            query_tokens_penalties = """
-                SELECT u.tokens, u.penalties
-                FROM user u
-                WHERE u.user_id = ?
-                """
-            res = cur.execute(query_tokens_penalties,(thread.owner_id,))
-            (tokens,penalties) = res.fetchone()
+    # Stage timings of intake_request, as (count, total seconds, maximum seconds) by stage.
+    def record_intake_stage(self, stage, seconds):
+        (count, total, maximum) = self.intake_timings.get(stage, (0, 0.0, 0.0))
+        self.intake_timings[stage] = (count + 1, total + seconds, max(maximum, seconds))
 
-            if penalties >= self.max_penalties:
-                await self.log_error(db,f"{user_mention} tried to create a new request but they have {self.penalties(penalties)}",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you have {self.penalties(penalties)}. You are not allowed to create requests with these many penalties. If you would like to have penalties removed, contact Staff to understand the reason you received them.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to penalties: {e}", cause_id = command_id)
-                await thread.delete()
-                db.close()
-                return
+    def intake_timing_summary(self):
+        if len(self.intake_timings) == 0:
+            return "No requests taken in yet."
 
-            # Check number of active requests
-            query_active = """
-                SELECT
-                    COUNT(*)
-                FROM request r
-                WHERE r.author_id = :user_id
-                    AND r.state IN (:open_state,:claimed_state)
-                """
-            data = {"user_id":thread.owner_id, "open_state":RequestState.OPEN.value,"claimed_state":RequestState.CLAIMED.value}
-            res = cur.execute(query_active,data)
-            requests = res.fetchone()[0]
-            
-            if requests >= self.max_requests:
-                await self.log_error(db,f"{user_mention} tried to create a new request but they already have {requests} requests open.",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you already have {requests} requests open. You may not have more than {self.max_requests} requests open at any one time (across all lists). Please wait until one of your requests is completed or cancel an unclaimed request.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to too many active requests: {e}", cause_id = command_id)
-                await thread.delete()
-                db.close()
-                return    
-
-            # Tokens
-            (list_option, request_type) = await self.get_request_type(db,thread)
-            # Here we assume this is the trusted critics list.
-            token_cost = self.trusted_critic_list_token_costs[request_type.value - 1]
-            token_reward = self.trusted_critic_list_token_rewards[request_type.value - 1]
-            if tokens < token_cost:
-                await self.log_error(db,f"{user_mention} tried to create a new request of type {request_type} but they only have {self.tokens(tokens)} and require {self.tokens(token_cost)}",thread.owner_id,cause_id=command_id)
-                user = await self.server_obj.fetch_member(thread.owner_id)
-                try:
-                    await self.send_dm(user,f"Your request \"{request_title}\" was deleted because you only have {self.tokens(tokens)} and require {self.tokens(token_cost)} to create a request of this type in the trusted critics list.")
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of deleted request due to insufficient tokens: {e}", cause_id = command_id)
-                await thread.delete()
-                db.close()
-                return
-            def token_update(previous):
-                return previous - token_cost
-            
-            # Create the request
-            thread_id = await self.create_request(db,thread,cause_id=command_id)
-            await self.update_tokens(db,thread.owner_id,token_update,request_id=thread_id,cause_id=command_id)
-            
-            # Make a post in the request with basic info.
-            try:
-                await self.send_thread(thread, f"✅The {thread.applied_tags[0].emoji.name}**{thread.applied_tags[0].name}** request has been registered. {user_mention} consumed {self.tokens(token_cost)}. {user_mention} now has {requests+1}/{self.max_requests} active requests.",mentions=False)
-                await self.send_thread(thread, f"Only trusted critics may respond to requests in this list. Responding to this request will reward {self.tokens(token_reward)}. {user_mention} may increase the token reward using `/addtokens`.",mentions=False)
-                await self.send_thread(thread, f"Possible actions for {user_mention}:\n- ✅Accept response and give reward - `/thanksforfeedback`\n- ✅Close request as finished - `/closerequest`\n- ❌Cancel the request (no responses) - `/cancelrequest`",mentions=False)
-            except Forbidden as e:
-                await self.log_system(db, f"Could not send messages in thread: {e}", cause_id = command_id)
-            #if not has_attachment:
-            #    await self.send_thread(thread,f"⚠️No attachment was detected on the original message. If this is a mistake, please remember to attach your map file now. Ignore if attachment isn't necessary.",mentions=False)
-
-        except Exception as e:                
-            await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
-            
-        db.close()
+        lines = ["Request intake stages:"]
+        for (stage, (count, total, maximum)) in self.intake_timings.items():
+            lines.append(f"- {stage}: {count} times, {1000*total/count:.1f}ms average, {1000*maximum:.1f}ms max")
+        return "\n".join(lines)
 
     async def deleterequest(self, thread: discord.Thread):
-        time.sleep(self.react_sleep)
-
         db = self.db_connect()
 
         try:            
             user_mention = self.mention_user(thread.owner_id)
             command_id = await self.log_command(db,f"A thread initiated by {user_mention} was deleted.",thread.owner_id)
 
-            if not check_request(db,thread.id):
+            if not await db.run(check_request,thread.id):
                 await self.log_error(db,f"Deleted thread initiated by {user_mention} was not found in the database.",thread.owner_id,cause_id=command_id)                
                 db.close()
                 return
             
-            cur = db.cursor()
-
             thread_id = thread.id
 
             query_request = """
@@ -1339,8 +1316,7 @@ class CriticsGuildButler(discord.Client):
                 FROM request r
                 WHERE r.thread_id = ?
                 """
-            res = cur.execute(query_request,(thread_id,))
-            (author_id,state_id,list_option_id,request_type_id) = res.fetchone()
+            (author_id,state_id,list_option_id,request_type_id) = await db.fetchone(query_request,(thread_id,))
             state = RequestState(state_id)
             list_option = RequestList(list_option_id)
             request_type = RequestType(request_type_id)
@@ -1352,36 +1328,37 @@ class CriticsGuildButler(discord.Client):
                 db.close()
                 return
 
-            # Change state.
+            # Change state and return tokens in one transaction, only if the request is still active, so that it can never be refunded twice.
             query_update = """
                 UPDATE request
-                SET state = :cancelled_state, critic_id = NULL
-                WHERE thread_id = :thread_id
+                SET state = :cancelled_state, critic_id = NULL, closed_at = :closed_at
+                WHERE thread_id = :thread_id AND state IN (:open_state, :claimed_state)
+                RETURNING list, type
                 """
-            data = {"cancelled_state":RequestState.CANCELLED.value,"thread_id":thread_id}
-            res = cur.execute(query_update,data)
-                
-            # Return tokens
-            if list_option == RequestList.OPEN:
-                tokens_returned_str = ""
-            elif list_option == RequestList.CRITIC:
-                token_cost = self.critic_list_token_costs[request_type.value - 1]
-                def token_update(previous):
-                    return previous + token_cost
+            data = {"cancelled_state":RequestState.CANCELLED.value,"closed_at":int(time.time()),"thread_id":thread_id,"open_state":RequestState.OPEN.value,"claimed_state":RequestState.CLAIMED.value}
 
-                await self.update_tokens(db,author_id,token_update,request_id=thread_id,cause_id=command_id)
-                tokens_returned_str = f"{self.tokens(token_cost)} were returned to you. "
-            elif list_option == RequestList.TRUSTED_CRITIC:
-                token_cost = self.trusted_critic_list_token_costs[request_type.value - 1]
-                def token_update(previous):
-                    return previous + token_cost
+            def cancel(conn):
+                return conn.execute(query_update,data).fetchone()
+
+            changes = [{"user_id":author_id, "counter":"tokens", "delta":lambda row: self.request_prices[(RequestList(row[0]), RequestType(row[1]))][0]}]
+            results = await self.update_counters(db,changes,request_id=thread_id,cause_id=command_id,prepare=cancel)
+            if results is None:
+                await self.log_result(db, f"A thread initiated by {user_mention} was deleted, but the request was already cancelled or completed. Doing nothing as a result.",thread.owner_id,request_id=thread_id,cause_id=command_id)                
+                db.close()
+                return
+            # The active request count was changed by the database.
+            self.user_cache.invalidate(author_id)
 
-                await self.update_tokens(db,author_id,token_update,request_id=thread_id,cause_id=command_id)
-                tokens_returned_str = f"{self.tokens(token_cost)} were returned to you. "              
+            (previous_tokens, new_tokens) = results[0]
+            token_cost = new_tokens - previous_tokens
+            if token_cost > 0:
+                tokens_returned_str = f"{self.tokens(token_cost)} were returned to you. "
+            else:
+                tokens_returned_str = ""
                
             await self.log_result(db,f"A thread initiated by {user_mention} was deleted, and the associated request was cancelled.",thread.owner_id,request_id=thread_id,cause_id=command_id)
                             
-            user = await self.server_obj.fetch_member(thread.owner_id)
+            user = await self.lookup_member(thread.owner_id)
             try:
                 await self.send_dm(user,f"A request thread you created on the critic's guild was deleted. {tokens_returned_str}This should not be the norm, if it was you who deleted the thread, please do not do this in the future as it can create issues. Instead, use `/cancelrequest`. If it was not you who deleted the thread, consider letting a member of Staff know of the issue.")
             except Forbidden as e:
@@ -1407,10 +1384,10 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)                
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)
+                channel_obj = await self.lookup_channel(interaction.channel_id)
                 command_id = await self.log_command(db,f"{user_mention} tried to add {self.tokens(tokens)} to {channel_obj.jump_url}.",interaction.user.id)
                 
-                if not check_request(db,interaction.channel_id):
+                if not await db.run(check_request,interaction.channel_id):
                     await self.log_error(db,f"{user_mention} tried to add tokens to {channel_obj.jump_url} but the request could not be found in the database.",interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,f"This channel does not appear in the database as a request.")
                     db.close()
@@ -1420,8 +1397,6 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                cur = db.cursor()
-
                 thread_id = interaction.channel_id
 
                 query_request = """
@@ -1429,13 +1404,12 @@ class CriticsGuildButler(discord.Client):
                     FROM request r
                     WHERE r.thread_id = ?
                     """
-                res = cur.execute(query_request,(thread_id,))
-                (author_id,state_id,list_option_id,request_type_id) = res.fetchone()
+                (author_id,state_id,list_option_id,request_type_id) = await db.fetchone(query_request,(thread_id,))
                 state = RequestState(state_id)
                 list_option = RequestList(list_option_id)
                 request_type = RequestType(request_type_id)
                 author_mention = self.mention_user(author_id)   
-                author_obj = await self.fetch_user(author_id)
+                author_obj = await self.lookup_user(author_id)
 
                 if tokens <= 0:
                     await self.log_error(db, summary=f"{user_mention} tried to add negative tokens to a request.", user_id=interaction.user.id,cause_id=command_id)
@@ -1443,29 +1417,22 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                query_available_tokens = """
-                    SELECT
-                        u.tokens
-                    FROM user u
-                    WHERE u.user_id = ?
-                """
-                res = cur.execute(query_available_tokens,(interaction.user.id,))
-                available_tokens = res.fetchone()[0]
+                # Both sides of the transfer happen in one transaction, which is rolled back if the user does not have enough tokens.
+                changes = [
+                    {"user_id":interaction.user.id, "counter":"tokens", "delta":-tokens, "minimum":0},
+                    {"request_id":thread_id, "counter":"additional_tokens", "delta":tokens}
+                ]
+                results = await self.update_counters(db,changes,cause_id=command_id)
+
+                if results is None:
+                    available_tokens = (await self.get_user_state(db,interaction.user.id))["tokens"]
 
-                if available_tokens < tokens:
                     await self.log_error(db, summary=f"{user_mention} tried to add {self.tokens(tokens)} to {channel_obj.jump_url} but they only had {self.tokens(available_tokens)} available.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,content=f"You only have {self.tokens(available_tokens)}.")                    
                     db.close()
                     return
 
-                def reduce_tokens_fun(previous):
-                    return previous - tokens
-
-                def increase_tokens_fun(previous):
-                    return previous + tokens
-
-                (previous_self_tokens, new_self_tokens) = await self.update_tokens(db,interaction.user.id,reduce_tokens_fun,cause_id=command_id)
-                (previous_request_tokens, new_request_tokens) = await self.update_tokens_request(db,thread_id,increase_tokens_fun,cause_id=command_id)
+                [(previous_self_tokens, new_self_tokens), (previous_request_tokens, new_request_tokens)] = results
 
                 total_request_tokens = await self.calculate_request_tokens(db, thread_id)
 
@@ -1491,16 +1458,16 @@ class CriticsGuildButler(discord.Client):
             await self.defer(interaction)
             
             db = self.db_connect()
+            lookup_tasks = []
 
             try:
                 user_mention = self.mention_user(interaction.user.id)                
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)
                 critic_id = critic.id
                 critic_mention = self.mention_user(critic_id)
-                critic_obj = await self.fetch_user(critic_id)
+                channel_obj = await self.lookup_channel(interaction.channel_id)
                 command_id = await self.log_command(db,f"{user_mention} acknowledged feedback in {channel_obj.jump_url} to critic {critic_mention}.",interaction.user.id)
 
-                if not check_request(db,interaction.channel_id):
+                if not await db.run(check_request,interaction.channel_id):
                     await self.log_error(db,f"{user_mention} tried to acknowledge feedback in {channel_obj.jump_url} but the request could not be found in the database.",interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,f"This channel does not appear in the database as a request.")
                     db.close()
@@ -1510,8 +1477,6 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                cur = db.cursor()
-
                 thread_id = interaction.channel_id
 
                 query_request = """
@@ -1519,13 +1484,11 @@ class CriticsGuildButler(discord.Client):
                     FROM request r
                     WHERE r.thread_id = ?
                     """
-                res = cur.execute(query_request,(thread_id,))
-                (author_id,state_id,list_option_id,request_type_id) = res.fetchone()
+                (author_id,state_id,list_option_id,request_type_id) = await db.fetchone(query_request,(thread_id,))
                 state = RequestState(state_id)
                 list_option = RequestList(list_option_id)
                 request_type = RequestType(request_type_id)
                 author_mention = self.mention_user(author_id)   
-                author_obj = await self.fetch_user(author_id)
                 
                 # Check the state of the request
                 if state == RequestState.OPEN:
@@ -1541,53 +1504,67 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return                
                 
-                # Return tokens
-                def token_update_critic(previous):
-                    return previous + token_reward
-                
-                creation_date = channel_obj.created_at                                
-
-                token_reward = await self.calculate_request_tokens(db,thread_id)
+                # The critic and the author are only needed for the DMs at the end, so they are fetched while the reward is applied.
+                critic_task = asyncio.create_task(self.lookup_user(critic_id))
+                lookup_tasks.append(critic_task)
+                if interaction.user.id != author_id:
+                    author_task = asyncio.create_task(self.lookup_user(author_id))
+                    lookup_tasks.append(author_task)
+
+                # Reward the critic, count the completed request and clear the additional tokens from the request, all at once, and only
+                # if the request is still open or claimed. The reward is computed from the request as it is inside the transaction,
+                # so that overlapping acknowledgements or /addtokens can neither pay the additional tokens twice nor lose them.
+                # The row is read before being updated because RETURNING would give the additional tokens after clearing them.
+                query_reward = """
+                    SELECT r.list,r.type,r.additional_tokens,r.created_at
+                    FROM request r
+                    WHERE r.thread_id = :thread_id AND r.state IN (:open_state, :claimed_state)
+                    """
+                data = {"thread_id":thread_id, "open_state":RequestState.OPEN.value, "claimed_state":RequestState.CLAIMED.value}
+
+                def clear_additional_tokens(conn):
+                    row = conn.execute(query_reward,data).fetchone()
+                    if not row is None:
+                        conn.execute("UPDATE request SET additional_tokens = 0 WHERE thread_id = ?", (thread_id,))
+                    return row
+
+                changes = [
+                    {"user_id":critic_id, "counter":"tokens", "delta":lambda row: self.request_token_reward(RequestList(row[0]),RequestType(row[1]),row[2],row[3])},
+                    {"user_id":critic_id, "counter":"completed_critic_requests", "delta":1, "log":False}
+                ]
+                results = await self.update_counters(db,changes,request_id=thread_id,cause_id=command_id,prepare=clear_additional_tokens)
+                if results is None:
+                    for task in lookup_tasks:
+                        task.cancel()
+                    await self.log_error(db, f"{user_mention} tried to acknowledge feedback in {channel_obj.jump_url} but the request is not in open or claimed state.",interaction.user.id,request_id=thread_id,cause_id=command_id)
+                    await self.send_response(interaction, f"You cannot acknowledge feedback because this request is not open.")
+                    db.close()
+                    return
 
-                await self.update_tokens(db,critic_id,token_update_critic,request_id=thread_id,cause_id=command_id)
+                (previous_tokens, new_tokens) = results[0]
+                token_reward = new_tokens - previous_tokens
 
                 critic_dm_str = f"You received {self.tokens(token_reward)} as reward."
 
                 tokens_returned_str = f"{self.tokens(token_reward)} were rewarded to {critic_mention} for responding to this request."                
 
-                # Updated completed requests for critic                
-                query_update_critic = """
-                    UPDATE user
-                    SET completed_critic_requests = completed_critic_requests + 1
-                    WHERE user_id = :critic_id
-                    """
-                data = {"critic_id":critic_id}
-                res = cur.execute(query_update_critic,data)                                
-                
-                # Clear additional tokens from request
-                def token_update_request(previous):
-                    return 0
+                # Send messages. None of them depends on the others, so they are all sent at once.
+                async def dm_author():
+                    author_obj = await author_task
+                    await self.send_dm(author_obj,f"{critic_mention} responded to your request {channel_obj.jump_url}. Would you recommend {critic_mention} as a good critic?",view=self.CompletedVoteCritic(self,thread_id,critic_id))
 
-                await self.update_tokens_request(db, thread_id, token_update_request)
+                async def dm_critic():
+                    critic_obj = await critic_task
+                    await self.send_dm(critic_obj,f"You responded to the request {channel_obj.jump_url} by {author_mention}. {critic_dm_str} Would you recommend {author_mention} as a good mapper to interact with?",view=self.CompletedVoteMapper(self,thread_id,author_id))
 
-                # Send messages
+                steps = []
                 if interaction.user.id != author_id:
-                    try:
-                        await self.send_dm(author_obj,f"{critic_mention} responded to your request {channel_obj.jump_url}. Would you recommend {critic_mention} as a good critic?",view=self.CompletedVoteCritic(self,thread_id,critic_id))
-                    except Forbidden as e:
-                        await self.log_system(db, f"Could not send DM informing user of feedback acknowledged: {e}", cause_id = command_id)
-
-                try:
-                    await self.send_dm(critic_obj,f"You responded to the request {channel_obj.jump_url} by {author_mention}. {critic_dm_str} Would you recommend {author_mention} as a good mapper to interact with?",view=self.CompletedVoteMapper(self,thread_id,author_id))
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send DM informing user of feedback acknowledged: {e}", cause_id = command_id)
+                    steps.append(("send DM informing user of feedback acknowledged", dm_author()))
+                steps.append(("send DM informing critic of feedback acknowledged", dm_critic()))
+                steps.append(("send message in thread", self.send_thread(channel_obj, f"✅{tokens_returned_str}",mentions=False)))
+                steps.append(("log the result", self.log_result(db,f"{user_mention} acknowledged feedback in {channel_obj.jump_url} by {critic_mention}.",interaction.user.id,request_id=thread_id,cause_id=command_id)))
 
-                try:
-                    await self.send_thread(channel_obj, f"✅{tokens_returned_str}",mentions=False)
-                except Forbidden as e:
-                    await self.log_system(db, f"Could not send message in thread: {e}", cause_id = command_id)
-                
-                await self.log_result(db,f"{user_mention} acknowledged feedback in {channel_obj.jump_url} by {critic_mention}.",interaction.user.id,request_id=thread_id,cause_id=command_id)
+                await self.fan_out(db, steps, cause_id=command_id)
 
                 if close:
                     await self.do_close_request(db,interaction,user_mention,channel_obj,command_id)
@@ -1597,6 +1574,9 @@ class CriticsGuildButler(discord.Client):
                 else:
                     await self.send_response(interaction, f"Feedback has been acknowledged.")
             except Exception as e:                
+                # Lookups that nothing will wait for anymore.
+                for task in lookup_tasks:
+                    task.cancel()
                 await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
             
             db.close()
@@ -1612,10 +1592,10 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)                
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)
+                channel_obj = await self.lookup_channel(interaction.channel_id)
                 command_id = await self.log_command(db,f"{user_mention} attempted to close {channel_obj.jump_url}.",interaction.user.id)
 
-                if not check_request(db,interaction.channel_id):
+                if not await db.run(check_request,interaction.channel_id):
                     await self.log_error(db,f"{user_mention} tried to close the request {channel_obj.jump_url} but the request could not be found in the database.",interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,f"This channel does not appear in the database as a request.")
                     db.close()
@@ -1627,15 +1607,12 @@ class CriticsGuildButler(discord.Client):
 
                 thread_id = interaction.channel_id
 
-                cur = db.cursor()
-
                 query_request = """
                     SELECT r.author_id,r.state,r.list,r.type
                     FROM request r
                     WHERE r.thread_id = ?
                     """
-                res = cur.execute(query_request,(thread_id,))
-                (author_id,state_id,list_option_id,request_type_id) = res.fetchone()
+                (author_id,state_id,list_option_id,request_type_id) = await db.fetchone(query_request,(thread_id,))
                 state = RequestState(state_id)
                 list_option = RequestList(list_option_id)
                 request_type = RequestType(request_type_id)
@@ -1666,34 +1643,20 @@ class CriticsGuildButler(discord.Client):
                 user_mention = self.mention_user(interaction.user.id)
                 command_id = await self.log_command(db,f"{user_mention} claimed monthly tokens.",interaction.user.id)
 
-                check_user(db,interaction.user.id)
+                await self.check_user(db,interaction.user.id)
 
-                cur = db.cursor()
+                # The claim flag can only go from 0 to 1, so a second claim is rolled back together with its tokens.
+                changes = [
+                    {"user_id":interaction.user.id, "counter":"claimed_tokens", "delta":1, "maximum":1, "log":False},
+                    {"user_id":interaction.user.id, "counter":"tokens", "delta":self.monthly_tokens}
+                ]
+                results = await self.update_counters(db,changes,cause_id=command_id)
 
-                query_check_claimed = """
-                    SELECT
-                        u.claimed_tokens
-                    FROM user u
-                    WHERE u.user_id = ?
-                """
-                res = cur.execute(query_check_claimed,(interaction.user.id,))
-                claimed_tokens = res.fetchone()[0]
-
-                if claimed_tokens != 0:
+                if results is None:
                     await self.log_error(db, summary=f"{user_mention} tried to claim {self.tokens(self.monthly_tokens)} more than once this month.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,content=f"You have already claimed your {self.tokens(self.monthly_tokens)} this month. Please wait until the end of the month to claim again.")                    
                 else:
-                    query_set_claimed = """
-                        UPDATE user
-                        SET claimed_tokens = 1
-                        WHERE user_id = ?
-                    """
-                    res = cur.execute(query_set_claimed,(interaction.user.id,))
-
-                    def claim_tokens_fun(previous):
-                        return previous + self.monthly_tokens
-
-                    (previous_tokens, new_tokens) = await self.update_tokens(db,interaction.user.id,claim_tokens_fun,cause_id=command_id)
+                    [(previous_claimed, new_claimed), (previous_tokens, new_tokens)] = results
 
                     await self.send_response(interaction, f"You have claimed your monthly {self.tokens(self.monthly_tokens)}, and now have {self.tokens(new_tokens)} in total.")
             except Exception as e:                
@@ -1713,7 +1676,7 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} gifted {self.tokens(tokens)} to {target_user_mention}.",interaction.user.id)
 
-                check_user(db,interaction.user.id)                
+                await self.check_user(db,interaction.user.id)                
 
                 if user.id == interaction.user.id:
                     await self.log_error(db, summary=f"{user_mention} tried to gift {self.tokens(tokens)} to themselves.", user_id=interaction.user.id,cause_id=command_id)
@@ -1721,43 +1684,34 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                if not check_user(db,user.id,create=False):
+                if not await self.check_user(db,user.id,create=False):
                     await self.log_error(db, summary=f"{target_user_mention} cannot be gifted {self.tokens(-1)} because they have never interacted with the bot before.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction, f"{target_user_mention} cannot be gifted {self.tokens(-1)} because they have never interacted with the bot before. This is an intentional limitation. Please do not gift tokens to users unless they have participated in the guild before.")
                     db.close()
                     return
 
-                cur = db.cursor()
-
                 if tokens <= 0:
                     await self.log_error(db, summary=f"{user_mention} tried to gift {self.tokens(0)}.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,f"Please introduce a positive amount of {self.tokens(-1)} to gift.")
                     db.close()
                     return
 
-                query_available_tokens = """
-                    SELECT
-                        u.tokens
-                    FROM user u
-                    WHERE u.user_id = ?
-                """
-                res = cur.execute(query_available_tokens,(interaction.user.id,))
-                available_tokens = res.fetchone()[0]
+                # Both sides of the gift happen in one transaction, which is rolled back if the user does not have enough tokens.
+                changes = [
+                    {"user_id":interaction.user.id, "counter":"tokens", "delta":-tokens, "minimum":0},
+                    {"user_id":user.id, "counter":"tokens", "delta":tokens}
+                ]
+                results = await self.update_counters(db,changes,cause_id=command_id)
+
+                if results is None:
+                    available_tokens = (await self.get_user_state(db,interaction.user.id))["tokens"]
 
-                if available_tokens < tokens:
                     await self.log_error(db, summary=f"{user_mention} tried to gift {self.tokens(tokens)} to {target_user_mention} but they only had {self.tokens(available_tokens)} available.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,content=f"You only have {self.tokens(available_tokens)}.")                    
                     db.close()
                     return
-                
-                def reduce_tokens_fun(previous):
-                    return previous - tokens
 
-                def increase_tokens_fun(previous):
-                    return previous + tokens
-
-                (previous_self_tokens, new_self_tokens) = await self.update_tokens(db,interaction.user.id,reduce_tokens_fun,cause_id=command_id)
-                (previous_other_tokens, new_other_tokens) = await self.update_tokens(db,user.id,increase_tokens_fun,cause_id=command_id)
+                [(previous_self_tokens, new_self_tokens), (previous_other_tokens, new_other_tokens)] = results
 
                 try:
                     await self.send_dm(user, f"{user_mention} gifted you {self.tokens(tokens)} and you now have {self.tokens(new_other_tokens)} in total.")
@@ -1769,6 +1723,39 @@ class CriticsGuildButler(discord.Client):
             
             db.close()
 
+        @self.tree.command(description=f"Check your position in the leaderboards.")
+        @app_commands.describe(user="User to check the position of. Yourself by default.")
+        async def rank(interaction: discord.Interaction, user: discord.Member = None):
+            await self.defer(interaction)
+
+            db = self.db_connect()
+
+            try:
+                if user is None:
+                    user = interaction.user
+
+                user_mention = self.mention_user(interaction.user.id)
+                target_mention = self.mention_user(user.id)
+                command_id = await self.log_command(db,f"{user_mention} checked the leaderboard position of {target_mention}.",interaction.user.id)
+
+                await self.check_user(db,user.id)
+
+                embed = discord.Embed(title=f"Leaderboard position of {user.display_name}")
+                for (counter, name, display) in self.rank_boards():
+                    lines = []
+                    for (position, user_id, value) in self.rankings[counter].around(user.id, self.rank_neighbours):
+                        line = f"{position} - {self.mention_user(user_id)} - {display(value)}"
+                        if user_id == user.id:
+                            line = f"**{line}**"
+                        lines.append(line)
+                    embed.add_field(name=f"{name} (#{self.rankings[counter].rank(user.id)} of {len(self.rankings[counter])})", value="\n".join(lines), inline=False)
+
+                await self.send_response(interaction, embed=embed)
+            except Exception as e:                
+                await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
+            
+            db.close()
+
         @self.tree.command(description=f"Check how many {self.tokens(-1)} you have.")
         async def checktokens(interaction: discord.Interaction):
             await self.defer(interaction)
@@ -1779,19 +1766,9 @@ class CriticsGuildButler(discord.Client):
                 user_mention = self.mention_user(interaction.user.id)
                 command_id = await self.log_command(db,f"{user_mention} checked their {self.tokens(-1)}",interaction.user.id)
 
-                check_user(db,interaction.user.id)
-
-                cur = db.cursor()
-
-                query_check_tokens = """
-                    SELECT
-                        u.tokens,
-                        u.claimed_tokens
-                    FROM user u
-                    WHERE u.user_id = ?
-                """
-                res = cur.execute(query_check_tokens,(interaction.user.id,))
-                (tokens,claimed) = res.fetchone()
+                user_state = await self.get_user_state(db,interaction.user.id)
+                tokens = user_state["tokens"]
+                claimed = user_state["claimed_tokens"]
                 
                 if claimed != 0:
                     await self.send_response(interaction, f"You have {self.tokens(tokens)}.")
@@ -1812,18 +1789,7 @@ class CriticsGuildButler(discord.Client):
                 user_mention = self.mention_user(interaction.user.id)
                 command_id = await self.log_command(db,f"{user_mention} checked their {self.penalties(-1)}",interaction.user.id)
 
-                check_user(db,interaction.user.id)
-
-                cur = db.cursor()
-
-                query_check_penalties = """
-                    SELECT
-                        u.penalties
-                    FROM user u
-                    WHERE u.user_id = ?
-                """
-                res = cur.execute(query_check_penalties,(interaction.user.id,))
-                penalties = res.fetchone()[0]
+                penalties = (await self.get_user_state(db,interaction.user.id))["penalties"]
                 
                 await self.send_response(interaction, f"You have {self.penalties(penalties)}.")                
             except Exception as e:                
@@ -1840,10 +1806,10 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)                
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)
+                channel_obj = await self.lookup_channel(interaction.channel_id)
                 command_id = await self.log_command(db,f"{user_mention} attempted to cancel {channel_obj.jump_url} with reason: {reason}.",interaction.user.id)
 
-                if not check_request(db,interaction.channel_id):
+                if not await db.run(check_request,interaction.channel_id):
                     await self.log_error(db,f"{user_mention} tried to cancel the request {channel_obj.jump_url} but the request could not be found in the database.",interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,f"This channel does not appear in the database as a request.")
                     db.close()
@@ -1853,8 +1819,6 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                cur = db.cursor()
-
                 thread_id = interaction.channel_id
 
                 query_request = """
@@ -1862,8 +1826,7 @@ class CriticsGuildButler(discord.Client):
                     FROM request r
                     WHERE r.thread_id = ?
                     """
-                res = cur.execute(query_request,(thread_id,))
-                (author_id,state_id,list_option_id,request_type_id,additional_tokens) = res.fetchone()
+                (author_id,state_id,list_option_id,request_type_id,additional_tokens) = await db.fetchone(query_request,(thread_id,))
                 state = RequestState(state_id)
                 list_option = RequestList(list_option_id)
                 request_type = RequestType(request_type_id)
@@ -1876,49 +1839,36 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                # Change state. There should be no critic stake (it wouldn't be cancellable)
+                # Change state and return tokens in one transaction, only if the request is still open, so that the refund is computed
+                # from the additional tokens the request has right then, and can never happen twice.
+                # There should be no critic stake (it wouldn't be cancellable)
                 query_update = """
                     UPDATE request
-                    SET state = :cancelled_state
-                    WHERE thread_id = :thread_id
+                    SET state = :cancelled_state, closed_at = :closed_at
+                    WHERE thread_id = :thread_id AND state = :open_state
+                    RETURNING list, type, additional_tokens
                     """
-                data = {"cancelled_state":RequestState.CANCELLED.value,"thread_id":thread_id}
-                res = cur.execute(query_update,data)
+                data = {"cancelled_state":RequestState.CANCELLED.value,"closed_at":int(time.time()),"thread_id":thread_id,"open_state":RequestState.OPEN.value}
+
+                def cancel(conn):
+                    return conn.execute(query_update,data).fetchone()
+
+                changes = [{"user_id":author_id, "counter":"tokens", "delta":lambda row: self.request_prices[(RequestList(row[0]), RequestType(row[1]))][0] + row[2]}]
+                results = await self.update_counters(db,changes,request_id=thread_id,cause_id=command_id,prepare=cancel)
+                if results is None:
+                    await self.log_error(db, f"{user_mention} tried to cancel {channel_obj.jump_url} but the request is not in open state.",interaction.user.id,request_id=thread_id,cause_id=command_id)
+                    await self.send_response(interaction, f"You cannot cancel this request because it is not in open state.")
+                    db.close()
+                    return
+                # The active request count was changed by the database.
+                self.user_cache.invalidate(author_id)
                 
-                # Return tokens
-                if list_option == RequestList.OPEN:
-                    token_cost = additional_tokens
-
-                    if token_cost > 0:
-                        def token_update(previous):
-                            return previous + token_cost
-
-                        await self.update_tokens(db,author_id,token_update,request_id=thread_id,cause_id=command_id)
-                        tokens_returned_str = f"{self.tokens(token_cost)} were returned to {author_mention}."
-                    else:
-                        tokens_returned_str = ""
-                elif list_option == RequestList.CRITIC:
-                    token_cost = self.critic_list_token_costs[request_type.value - 1] + additional_tokens
-
-                    if token_cost > 0:
-                        def token_update(previous):
-                            return previous + token_cost
-
-                        await self.update_tokens(db,author_id,token_update,request_id=thread_id,cause_id=command_id)
-                        tokens_returned_str = f"{self.tokens(token_cost)} were returned to {author_mention}."
-                    else:
-                        tokens_returned_str = ""
-                elif list_option == RequestList.TRUSTED_CRITIC:
-                    token_cost = self.trusted_critic_list_token_costs[request_type.value - 1] + additional_tokens
-
-                    if token_cost > 0:
-                        def token_update(previous):
-                            return previous + token_cost
-
-                        await self.update_tokens(db,author_id,token_update,request_id=thread_id,cause_id=command_id)
-                        tokens_returned_str = f"{self.tokens(token_cost)} were returned to {author_mention}."
-                    else:
-                        tokens_returned_str = ""
+                (previous_tokens, new_tokens) = results[0]
+                token_cost = new_tokens - previous_tokens
+                if token_cost > 0:
+                    tokens_returned_str = f"{self.tokens(token_cost)} were returned to {author_mention}."
+                else:
+                    tokens_returned_str = ""
                 
                 # Lock the thread
                 try:
@@ -1965,7 +1915,7 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return
 
-                if not check_user(db,user.id,create=False):
+                if not await self.check_user(db,user.id,create=False):
                     await self.log_error(db, summary=f"{target_user_mention} cannot be rewarded {self.tokens(-1)} because they have never interacted with the bot before.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction, f"{target_user_mention} cannot be rewarded {self.tokens(-1)} because they have never interacted with the bot before. This is an intentional limitation. Please do not reward users unless they have participated in the guild before.")
                     db.close()
@@ -1977,10 +1927,7 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return                
                                 
-                def increase_tokens_fun(previous):
-                    return previous + tokens
-
-                (previous_tokens, new_tokens) = await self.update_tokens(db,user.id,increase_tokens_fun,cause_id=command_id)
+                (previous_tokens, new_tokens) = await self.update_tokens(db,user.id,delta=tokens,cause_id=command_id)
 
                 await self.send_response(interaction, f"You rewarded {target_user_mention} {self.tokens(tokens)}.")
                 try:
@@ -2008,16 +1955,13 @@ class CriticsGuildButler(discord.Client):
                     db.close()
                     return                
                 
-                if not check_user(db,user.id,create=False):
+                if not await self.check_user(db,user.id,create=False):
                     await self.log_error(db, summary=f"{target_user_mention} cannot be rewarded {self.stars(1)} because they have never interacted with the bot before.", user_id=interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction, f"{target_user_mention} cannot be rewarded {self.stars(1)} because they have never interacted with the bot before. This is an intentional limitation. Please do not reward users unless they have participated in the guild before.")
                     db.close()
                     return
                                 
-                def increase_stars_fun(previous):
-                    return previous + 1
-
-                (previous_stars, new_stars) = await self.update_stars(db,user.id,increase_stars_fun,cause_id=command_id)
+                (previous_stars, new_stars) = await self.update_stars(db,user.id,delta=1,cause_id=command_id)
 
                 await self.send_response(interaction, f"You rewarded {target_user_mention} {self.stars(1)}.")                
                 try:
@@ -2039,7 +1983,7 @@ class CriticsGuildButler(discord.Client):
         @app_commands.checks.has_permissions(manage_guild=True)
         async def ping(interaction: discord.Interaction):
             await self.defer(interaction)
-            await self.send_response(interaction,f"Pong. Version info: {butler_version}")
+            await self.send_response(interaction,f"Pong. Version info: {butler_version}\n{self.cache_summary()}\n{self.log_writer_summary()}\n{self.outbound_summary()}\n{self.intake_timing_summary()}")
 
         @self.tree.command(description="(Admin only) Make the butler go offline.")
         @app_commands.default_permissions(manage_guild=True)
@@ -2077,9 +2021,7 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} checked the status of {target_user_mention}.",interaction.user.id)
 
-                check_user(db,user.id)
-
-                cur = db.cursor()
+                await self.check_user(db,user.id)
 
                 query = """
                     SELECT
@@ -2097,7 +2039,6 @@ class CriticsGuildButler(discord.Client):
                     FROM user u
                     WHERE u.user_id = ?
                     """
-                res = cur.execute(query,(user.id,))
                 (tokens,
                 mapper_upvotes,
                 historic_mapper_upvotes,
@@ -2108,7 +2049,7 @@ class CriticsGuildButler(discord.Client):
                 penalties,
                 stakes,
                 completed_mapper_requests,
-                completed_critic_requests) = res.fetchone()
+                completed_critic_requests) = await db.fetchone(query,(user.id,))
 
                 query_mapper_requests = """
                     SELECT
@@ -2117,8 +2058,7 @@ class CriticsGuildButler(discord.Client):
                     WHERE r.author_id = :user_id AND r.state IN (:open, :claimed)
                     """
                 data = {"user_id": user.id, "open": RequestState.OPEN.value, "claimed":RequestState.CLAIMED.value}
-                res = cur.execute(query_mapper_requests,data)
-                mapper_thread_ids = [r[0] for r in res.fetchall()]
+                mapper_thread_ids = [r[0] for r in await db.fetchall(query_mapper_requests,data)]
 
                 query_critic_requests = """
                     SELECT
@@ -2127,8 +2067,7 @@ class CriticsGuildButler(discord.Client):
                     WHERE r.critic_id = :user_id AND r.state IN (:open, :claimed)
                     """
                 data = {"user_id": user.id, "open": RequestState.OPEN.value, "claimed":RequestState.CLAIMED.value}
-                res = cur.execute(query_critic_requests,data)
-                critic_thread_ids = [r[0] for r in res.fetchall()]
+                critic_thread_ids = [r[0] for r in await db.fetchall(query_critic_requests,data)]
 
                 result = textwrap.dedent(f"""
                         {target_user_mention} status:
@@ -2153,7 +2092,7 @@ class CriticsGuildButler(discord.Client):
                     await self.send_admin_channel("Active mapper requests:")                              
 
                     for mapper_thread_id in mapper_thread_ids:
-                        thread_str = await self.display_request(mapper_thread_id)
+                        thread_str = self.mention_request(mapper_thread_id)
                         await self.send_admin_channel(thread_str)
                 else:
                     await self.send_admin_channel("No active mapper requests.")                
@@ -2162,7 +2101,7 @@ class CriticsGuildButler(discord.Client):
                     await self.send_admin_channel("Active critic requests:")
 
                     for critic_thread_id in critic_thread_ids:
-                        thread_str = await self.display_request(critic_thread_id)
+                        thread_str = self.mention_request(critic_thread_id)
                         await self.send_admin_channel(thread_str)
                 else:
                     await self.send_admin_channel("No active critic requests")    
@@ -2187,8 +2126,6 @@ class CriticsGuildButler(discord.Client):
                 user_mention = self.mention_user(interaction.user.id)
                 command_id = await self.log_command(db,f"{user_mention} checked the list of open requests.",interaction.user.id)
                 
-                cur = db.cursor()
-
                 query = """
                     SELECT
                         r.thread_id,
@@ -2200,8 +2137,7 @@ class CriticsGuildButler(discord.Client):
                     WHERE r.state IN (:open, :claimed)
                     """
                 data = {"open": RequestState.OPEN.value, "claimed":RequestState.CLAIMED.value}
-                res = cur.execute(query,data)
-                requests = res.fetchall()
+                requests = await db.fetchall(query,data)
                 
                 await self.send_admin_channel(f"There are {len(requests)} open requests.\n")
 
@@ -2211,7 +2147,7 @@ class CriticsGuildButler(discord.Client):
 
                     author_mention = self.mention_user(author_id)                    
 
-                    request_mention = await self.display_request(thread_id)
+                    request_mention = self.mention_request(thread_id)
 
                     await self.send_admin_channel(f"{request_mention} by {author_mention} - In list {list_option}, of type {request_type}.\n")
                 
@@ -2230,7 +2166,7 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 command_id = await self.log_command(db,f"{user_mention} displayed the request wanted board in {channel_mention}.",interaction.user.id)
                 
@@ -2258,86 +2194,30 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} checked the log for {target_user_mention} (past {days} days, maximum of {max_messages} entries).",interaction.user.id)
 
-                check_user(db,user.id)
+                await self.check_user(db,user.id)
 
-                cur = db.cursor()
+                # Make sure buffered log entries, including the command just logged, are visible to the query.
+                await self.log_writer.flush()
 
-                query = """
+                query = f"""
                     SELECT
-                        l.log_id,
-                        l.request_id,
-                        datetime(l.timestamp),
-                        l.class,
-                        l.cause_id,
-                        l.summary
-                    FROM log l
+                        l.log_id
+                    FROM {self.log_table(days)} l
                     WHERE
-                        l.user_id = :user_id AND (julianday('now') - julianday(l.timestamp)) < :days
+                        l.user_id = :user_id AND l.timestamp >= :since
                         AND (
                             (:commands AND l.class = :command_class) OR
                             (:results AND l.class = :result_class) OR
                             (:errors AND l.class = :error_class)
                         )
-                    ORDER BY l.timestamp DESC
+                    ORDER BY l.timestamp DESC, l.log_id DESC
                     LIMIT :max_messages
                     """
-                data = {"user_id":user.id, "days": days, "commands": commands, "command_class": LogClass.COMMAND.value, "results": results, "result_class": LogClass.RESULT.value, "errors": errors, "error_class":LogClass.ERROR.value, "max_messages":max_messages}
-                res = cur.execute(query,data)
-                logs = res.fetchall()
+                data = {"user_id":user.id, "since": int(time.time()) - days*86400, "commands": commands, "command_class": LogClass.COMMAND.value, "results": results, "result_class": LogClass.RESULT.value, "errors": errors, "error_class":LogClass.ERROR.value, "max_messages":max_messages}
+                logs = await db.fetchall(query,data)
                 logs.reverse()
 
-                async def log_message(log,with_cause=with_tree,with_consequences=with_tree,prefix=""):
-                    (log_id, request_id, date_str, log_class_id, cause_id, summary) = log
-                    log_class = LogClass(log_class_id)                    
-
-                    message = f"{prefix}{self.get_class_icon(log_class)}{log_class.name}/{log_id} ({date_str}) - {summary}"
-
-                    if not request_id is None:
-                        thread_str = await self.display_request(request_id)
-                        message += f" (on {thread_str})"
-
-                    await self.send_admin_channel(message)
-
-                    if with_cause:
-                        query_cause = """
-                            SELECT
-                                l.log_id,
-                                l.request_id,
-                                datetime(l.timestamp),
-                                l.class,
-                                l.cause_id,
-                                l.summary
-                            FROM log l
-                            WHERE
-                                l.log_id = ?
-                            """
-                        res = cur.execute(query_cause,(cause_id,))
-                        log = res.fetchone()
-
-                        if log:
-                            await log_message(log,with_cause=True,with_consequences=False,prefix="caused by ")
-
-                    if with_consequences:
-                        query_consequences = """
-                            SELECT
-                                l.log_id,
-                                l.request_id,
-                                datetime(l.timestamp),
-                                l.class,
-                                l.cause_id,
-                                l.summary
-                            FROM log l
-                            WHERE
-                                l.cause_id = ?
-                            """
-                        res = cur.execute(query_consequences,(log_id,))
-                        logs = res.fetchall()
-
-                        for log in logs:
-                            await log_message(log,with_cause=False,with_consequences=True,prefix="with consequence ")
-                                
-                for log in logs:
-                    await log_message(log)                    
+                await self.send_log_trees(db, "User log", [log_id for (log_id,) in logs], with_tree, archived = days > self.log_archive_days)
 
                 await self.send_response(interaction, "Command complete.")
             except Exception as e:                
@@ -2356,89 +2236,37 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)
+                channel_obj = await self.lookup_channel(interaction.channel_id)
                 command_id = await self.log_command(db,f"{user_mention} checked the log for {channel_obj.jump_url} (past {days} days, maximum of {max_messages} entries).",interaction.user.id)
 
-                if not check_request(db,interaction.channel_id):
+                if not await db.run(check_request,interaction.channel_id):
                     await self.log_error(db,f"{user_mention} tried to check the request log for {channel_obj.jump_url} but the request could not be found in the database.",interaction.user.id,cause_id=command_id)
                     await self.send_response(interaction,f"This channel does not appear in the database as a request.")
                     db.close()
                     return
 
-                cur = db.cursor()
+                # Make sure buffered log entries, including the command just logged, are visible to the query.
+                await self.log_writer.flush()
 
-                query = """
+                query = f"""
                     SELECT
-                        l.log_id,
-                        l.user_id,
-                        datetime(l.timestamp),
-                        l.class,
-                        l.cause_id,
-                        l.summary
-                    FROM log l
+                        l.log_id
+                    FROM {self.log_table(days)} l
                     WHERE
-                        l.request_id = :request_id AND (julianday('now') - julianday(l.timestamp)) < :days
+                        l.request_id = :request_id AND l.timestamp >= :since
                         AND (
                             (:commands AND l.class = :command_class) OR
                             (:results AND l.class = :result_class) OR
                             (:errors AND l.class = :error_class)
                         )
-                    ORDER BY l.timestamp DESC
+                    ORDER BY l.timestamp DESC, l.log_id DESC
                     LIMIT :max_messages
                     """
-                data = {"request_id":interaction.channel_id, "days": days, "commands": commands, "command_class": LogClass.COMMAND.value, "results": results, "result_class": LogClass.RESULT.value, "errors": errors, "error_class":LogClass.ERROR.value, "max_messages":max_messages}
-                res = cur.execute(query,data)
-                logs = res.fetchall()
+                data = {"request_id":interaction.channel_id, "since": int(time.time()) - days*86400, "commands": commands, "command_class": LogClass.COMMAND.value, "results": results, "result_class": LogClass.RESULT.value, "errors": errors, "error_class":LogClass.ERROR.value, "max_messages":max_messages}
+                logs = await db.fetchall(query,data)
                 logs.reverse()
 
-                async def log_message(log,with_cause=with_tree,with_consequences=with_tree,prefix=""):
-                    (log_id, user_id, date_str, log_class_id, cause_id, summary) = log
-                    log_class = LogClass(log_class_id)                                        
-
-                    message = f"{prefix}{self.get_class_icon(log_class)}{log_class.name}/{log_id} ({date_str}) - {summary}"                                        
-
-                    await self.send_admin_channel(message)
-
-                    if with_cause:
-                        query_cause = """
-                            SELECT
-                                l.log_id,
-                                l.user_id,
-                                datetime(l.timestamp),
-                                l.class,
-                                l.cause_id,
-                                l.summary
-                            FROM log l
-                            WHERE
-                                l.log_id = ?
-                            """
-                        res = cur.execute(query_cause,(cause_id,))
-                        log = res.fetchone()
-
-                        if log:
-                            await log_message(log,with_cause=True,with_consequences=False,prefix="caused by ")
-
-                    if with_consequences:
-                        query_consequences = """
-                            SELECT
-                                l.log_id,
-                                l.user_id,
-                                datetime(l.timestamp),
-                                l.class,
-                                l.cause_id,
-                                l.summary
-                            FROM log l
-                            WHERE
-                                l.cause_id = ?
-                            """
-                        res = cur.execute(query_consequences,(log_id,))
-                        logs = res.fetchall()
-
-                        for log in logs:
-                            await log_message(log,with_cause=False,with_consequences=True,prefix="with consequence ")
-                                
-                for log in logs:
-                    await log_message(log)                    
+                await self.send_log_trees(db, "Request log", [log_id for (log_id,) in logs], with_tree, archived = days > self.log_archive_days, show_requests=False)
 
                 await self.send_response(interaction, "Command complete. Results can be found in log channel.")
             except Exception as e:                
@@ -2460,81 +2288,25 @@ class CriticsGuildButler(discord.Client):
             try:
                 user_mention = self.mention_user(interaction.user.id)
                 command_id = await self.log_command(db,f"{user_mention} checked the system log (past {days} days, maximum of {max_messages} entries).",interaction.user.id)
-                
-                cur = db.cursor()
 
-                query = """
+                # Make sure buffered log entries, including the command just logged, are visible to the query.
+                await self.log_writer.flush()
+
+                query = f"""
                     SELECT
-                        l.log_id,
-                        l.request_id,
-                        datetime(l.timestamp),
-                        l.class,
-                        l.cause_id,
-                        l.summary
-                    FROM log l
+                        l.log_id
+                    FROM {self.log_table(days)} l
                     WHERE
-                        (julianday('now') - julianday(l.timestamp)) < :days
-                        AND l.class = :system_class
-                    ORDER BY l.timestamp DESC
+                        l.class = :system_class
+                        AND l.timestamp >= :since
+                    ORDER BY l.timestamp DESC, l.log_id DESC
                     LIMIT :max_messages
                     """
-                data = {"days": days, "system_class":LogClass.SYSTEM.value, "max_messages":max_messages}
-                res = cur.execute(query,data)
-                logs = res.fetchall()
+                data = {"since": int(time.time()) - days*86400, "system_class":LogClass.SYSTEM.value, "max_messages":max_messages}
+                logs = await db.fetchall(query,data)
                 logs.reverse()
 
-                async def log_message(log,with_cause=with_tree,with_consequences=with_tree,prefix=""):
-                    (log_id, request_id, date_str, log_class_id, cause_id, summary) = log
-                    log_class = LogClass(log_class_id)                    
-
-                    message = f"{prefix}{self.get_class_icon(log_class)}{log_class.name}/{log_id} ({date_str}) - {summary}"
-
-                    if not request_id is None:
-                        thread_str = await self.display_request(request_id)
-                        message += f" (on {thread_str})"
-
-                    await self.send_admin_channel(message)
-
-                    if with_cause:
-                        query_cause = """
-                            SELECT
-                                l.log_id,
-                                l.request_id,
-                                datetime(l.timestamp),
-                                l.class,
-                                l.cause_id,
-                                l.summary
-                            FROM log l
-                            WHERE
-                                l.log_id = ?
-                            """
-                        res = cur.execute(query_cause,(cause_id,))
-                        log = res.fetchone()
-
-                        if log:
-                            await log_message(log,with_cause=True,with_consequences=False,prefix="caused by ")
-
-                    if with_consequences:
-                        query_consequences = """
-                            SELECT
-                                l.log_id,
-                                l.request_id,
-                                datetime(l.timestamp),
-                                l.class,
-                                l.cause_id,
-                                l.summary
-                            FROM log l
-                            WHERE
-                                l.cause_id = ?
-                            """
-                        res = cur.execute(query_consequences,(log_id,))
-                        logs = res.fetchall()
-
-                        for log in logs:
-                            await log_message(log,with_cause=False,with_consequences=True,prefix="with consequence ")
-                                
-                for log in logs:
-                    await log_message(log)                    
+                await self.send_log_trees(db, "System log", [log_id for (log_id,) in logs], with_tree, archived = days > self.log_archive_days)
 
                 await self.send_response(interaction, "Command complete.")
             except Exception as e:                
@@ -2542,6 +2314,66 @@ class CriticsGuildButler(discord.Client):
             
             db.close()
 
+        @self.tree.command(description="(Admin only) Export the log to a file.")
+        @app_commands.default_permissions(manage_guild=True)
+        @app_commands.checks.has_permissions(manage_guild=True)
+        @app_commands.describe(days="Number of past days to export.", user="Only export entries of this user.", request_id="Only export entries of this request (thread id).", log_class="Only export entries of this class.", with_tree="Include causal tree of every entry (causes and effects).", format="File format.")
+        async def exportlog(interaction: discord.Interaction, days:int = 30, user: discord.Member = None, request_id: str = None, log_class: LogClass = None, with_tree: bool = False, format: ExportFormat = ExportFormat.CSV):
+            await self.defer(interaction)
+            if not await self.check_admin_channel(interaction):                    
+                return
+
+            db = self.db_connect()
+
+            try:
+                user_mention = self.mention_user(interaction.user.id)
+                command_id = await self.log_command(db,f"{user_mention} exported the log (past {days} days) as {format.value}.",interaction.user.id)
+
+                if not request_id is None and not request_id.isdigit():
+                    await self.log_error(db,f"{user_mention} tried to export the log of request {request_id}, which is not a valid thread id.",interaction.user.id,cause_id=command_id)
+                    await self.send_response(interaction,f"The request id must be the id of the request's thread.")
+                    db.close()
+                    return
+
+                # Make sure buffered log entries are included in the export.
+                await self.log_writer.flush()
+
+                until = int(time.time())
+                since = until - days*86400
+                # The generator is bound to the shared connection, so it must only be advanced on the worker thread.
+                batches = await db.run(iter_log_batches, since, until,
+                                       user_id = None if user is None else user.id,
+                                       request_id = None if request_id is None else int(request_id),
+                                       log_class = None if log_class is None else log_class.value,
+                                       with_tree = with_tree,
+                                       archived = days > self.log_archive_days)
+
+                # The export is written to a temporary file as batches arrive, reading one batch per database worker call.
+                with tempfile.TemporaryDirectory() as directory:
+                    path = os.path.join(directory, f"log.{format.value}")
+
+                    n_rows = 0
+                    with open(path, "w", newline="", encoding="utf-8") as file:
+                        write_rows = row_writer(file, format.value)
+                        while True:
+                            batch = await db.run(lambda conn: next(batches, None))
+                            if batch is None:
+                                break
+                            write_rows(batch)
+                            n_rows += len(batch)
+
+                    if os.path.getsize(path) > self.server_obj.filesize_limit:
+                        await self.log_error(db,f"{user_mention} tried to export {n_rows} log rows but the file is too large to upload.",interaction.user.id,cause_id=command_id)
+                        await self.send_response(interaction,f"The export ({n_rows} rows) is too large to upload. Please export fewer days, filter it, or use exportlog.py on the server.")
+                        db.close()
+                        return
+
+                    await self.send_response(interaction, f"Exported {n_rows} log rows.", file=discord.File(path))
+            except Exception as e:                
+                await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
+            
+            db.close()
+
         @self.tree.command(description=f"(Admin only) Set {self.tokens(-1)} count of user.")
         @app_commands.default_permissions(manage_guild=True)
         @app_commands.checks.has_permissions(manage_guild=True)
@@ -2556,12 +2388,9 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} set {target_user_mention} to {self.tokens(tokens)} with reason: {reason}.",interaction.user.id)
 
-                check_user(db,user.id)
+                await self.check_user(db,user.id)
 
-                def set_tokens_fun(previous):
-                    return tokens
-
-                (previous_tokens, new_tokens) = await self.update_tokens(db,user.id,set_tokens_fun,cause_id=command_id)
+                (previous_tokens, new_tokens) = await self.update_tokens(db,user.id,value=tokens,cause_id=command_id)
 
                 await self.send_response(interaction, f"Tokens for {target_user_mention} set from {self.tokens(previous_tokens)} to {self.tokens(new_tokens)}.")
             except Exception as e:                
@@ -2583,12 +2412,9 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} set {target_user_mention} to {self.stars(stars)} with reason: {reason}.",interaction.user.id)
 
-                check_user(db,user.id)
-
-                def set_stars_fun(previous):
-                    return stars
+                await self.check_user(db,user.id)
 
-                (previous_stars, new_stars) = await self.update_stars(db,user.id,set_stars_fun,cause_id=command_id)
+                (previous_stars, new_stars) = await self.update_stars(db,user.id,value=stars,cause_id=command_id)
 
                 await self.send_response(interaction, f"Stars for {target_user_mention} set from {self.stars(previous_stars)} to {self.stars(new_stars)}.")
             except Exception as e:                
@@ -2610,12 +2436,9 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} set {target_user_mention} to {self.upvotes(upvotes)} (mapper) with reason: {reason}.",interaction.user.id)
 
-                check_user(db,user.id)
+                await self.check_user(db,user.id)
 
-                def set_upvotes_fun(previous):
-                    return upvotes
-
-                (previous_upvotes, new_upvotes) = await self.update_mapper_upvotes(db,user.id,set_upvotes_fun,cause_id=command_id)
+                (previous_upvotes, new_upvotes) = await self.update_mapper_upvotes(db,user.id,value=upvotes,cause_id=command_id)
 
                 await self.send_response(interaction, f"Mapper upvotes for {target_user_mention} set from {self.upvotes(previous_upvotes)} to {self.upvotes(new_upvotes)}.")
             except Exception as e:                
@@ -2637,12 +2460,9 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} set {target_user_mention} to {self.upvotes(upvotes)} (critic) with reason: {reason}.",interaction.user.id)
 
-                check_user(db,user.id)
-
-                def set_upvotes_fun(previous):
-                    return upvotes
+                await self.check_user(db,user.id)
 
-                (previous_upvotes, new_upvotes) = await self.update_critic_upvotes(db,user.id,set_upvotes_fun,cause_id=command_id)
+                (previous_upvotes, new_upvotes) = await self.update_critic_upvotes(db,user.id,value=upvotes,cause_id=command_id)
 
                 await self.send_response(interaction, f"Critic upvotes for {target_user_mention} set from {self.upvotes(previous_upvotes)} to {self.upvotes(new_upvotes)}.")
             except Exception as e:                
@@ -2664,12 +2484,9 @@ class CriticsGuildButler(discord.Client):
                 target_user_mention = self.mention_user(user.id)
                 command_id = await self.log_command(db,f"{user_mention} set {target_user_mention} to {self.penalties(penalties)} with reason: {reason}.",interaction.user.id)
 
-                check_user(db,user.id)
+                await self.check_user(db,user.id)
 
-                def set_penalties_fun(previous):
-                    return penalties
-
-                (previous_penalties, new_penalties) = await self.update_penalties(db,user.id,set_penalties_fun,cause_id=command_id)
+                (previous_penalties, new_penalties) = await self.update_penalties(db,user.id,value=penalties,cause_id=command_id)
 
                 await self.send_response(interaction, f"Penalties for {target_user_mention} set from {self.penalties(previous_penalties)} to {self.penalties(new_penalties)}.")
             except Exception as e:                
@@ -2690,7 +2507,7 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 if historic:
                     message = f"{user_mention} displayed the **historic** {self.stars(-1)} leaderboard (maximum of {max_critics} critics) in {channel_mention}."
@@ -2699,41 +2516,13 @@ class CriticsGuildButler(discord.Client):
 
                 command_id = await self.log_command(db,message,interaction.user.id)
                 
-                cur = db.cursor()
-
                 if historic:
-                    query = """
-                        SELECT
-                            u.user_id,
-                            u.stars,
-                            u.historic_stars
-                        FROM user u
-                        ORDER BY u.historic_stars DESC
-                        LIMIT :max_critics
-                        """
+                    critics = self.rankings["historic_stars"].top(max_critics)
                 else:
-                    query = """
-                        SELECT
-                            u.user_id,
-                            u.stars,
-                            u.historic_stars
-                        FROM user u
-                        ORDER BY u.stars DESC
-                        LIMIT :max_critics
-                        """
-                
-                data = {"max_critics":max_critics}
-                res = cur.execute(query,data)
-                critics = res.fetchall()                                
-                                
-                await self.send_channel(channel_obj, f"⭐STAR LEADERBOARD⭐ - TOP {max_critics}")
-
-                i = 0
-                for critic in critics:
-                    i += 1
-                    (user_id, stars, historic_stars) = critic
-                    critic_mention = self.mention_user(user_id)
-                    await self.send_channel(channel_obj, f"{i} - {critic_mention} - {self.stars(stars)}", mentions = False)
+                    critics = self.rankings["stars"].top(max_critics)
+
+                lines = [f"{i} - {self.mention_user(user_id)} - {self.stars(self.rankings['stars'].value(user_id))}" for (i, (user_id, value)) in enumerate(critics, 1)]
+                await self.send_leaderboard(channel_obj, f"⭐STAR LEADERBOARD⭐ - TOP {max_critics}", lines)
                 
                 await self.send_response(interaction, "Command complete.")
             except Exception as e:                
@@ -2754,7 +2543,7 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 message = f"{user_mention} checked the {self.tokens(-1)} leaderboard (maximum of {max_users} users) in {channel_mention}."
 
@@ -2781,7 +2570,7 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 if historic:
                     message = f"{user_mention} checked the **historic** critic {self.upvotes(-1)} leaderboard (maximum of {max_critics} critics) in {channel_mention}."
@@ -2811,7 +2600,7 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 if historic:
                     message = f"{user_mention} checked the **historic** mapper {self.upvotes(-1)} leaderboard (maximum of {max_mappers} mappers) in {channel_mention}."
@@ -2820,41 +2609,13 @@ class CriticsGuildButler(discord.Client):
 
                 command_id = await self.log_command(db,message,interaction.user.id)
                 
-                cur = db.cursor()
-
                 if historic:
-                    query = """
-                        SELECT
-                            u.user_id,
-                            u.mapper_upvotes,
-                            u.historic_mapper_upvotes
-                        FROM user u
-                        ORDER BY u.historic_mapper_upvotes DESC
-                        LIMIT :max_mappers
-                        """
+                    mappers = self.rankings["historic_mapper_upvotes"].top(max_mappers)
                 else:
-                    query = """
-                        SELECT
-                            u.user_id,
-                            u.mapper_upvotes,
-                            u.historic_mapper_upvotes
-                        FROM user u
-                        ORDER BY u.mapper_upvotes DESC
-                        LIMIT :max_mappers
-                        """
-                
-                data = {"max_mappers":max_mappers}
-                res = cur.execute(query,data)
-                mappers = res.fetchall()             
-                
-                await self.send_channel(channel_obj, f"👍UPVOTE LEADERBOARD👍 - TOP {max_mappers} mappers")
-                                
-                i = 0
-                for mapper in mappers:
-                    i += 1
-                    (user_id, mapper_upvotes, historic_mapper_upvotes) = mapper
-                    mapper_mention = self.mention_user(user_id)
-                    await self.send_channel(channel_obj, f"{i} - {mapper_mention} - {self.upvotes(mapper_upvotes)}", mentions = False)
+                    mappers = self.rankings["mapper_upvotes"].top(max_mappers)
+
+                lines = [f"{i} - {self.mention_user(user_id)} - {self.upvotes(self.rankings['mapper_upvotes'].value(user_id))}" for (i, (user_id, value)) in enumerate(mappers, 1)]
+                await self.send_leaderboard(channel_obj, f"👍UPVOTE LEADERBOARD👍 - TOP {max_mappers} mappers", lines)
                 
                 await self.send_response(interaction, "Command complete.")
             except Exception as e:                
@@ -2875,35 +2636,16 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 message = f"{user_mention} checked the critic completed requests leaderboard (maximum of {max_critics} critics) in {channel_mention}."
 
                 command_id = await self.log_command(db,message,interaction.user.id)
                 
-                cur = db.cursor()
+                critics = self.rankings["completed_critic_requests"].top(max_critics)
 
-                query = """
-                    SELECT
-                        u.user_id,
-                        u.completed_critic_requests
-                    FROM user u
-                    ORDER BY u.completed_critic_requests DESC
-                    LIMIT :max_critics
-                    """
-                
-                data = {"max_critics":max_critics}
-                res = cur.execute(query,data)
-                critics = res.fetchall() 
-                
-                await self.send_channel(channel_obj, f"✅COMPLETION LEADERBOARD✅ - TOP {max_critics}")
-                                
-                i = 0
-                for critic in critics:
-                    i += 1
-                    (user_id, critic_requests) = critic
-                    critic_mention = self.mention_user(user_id)
-                    await self.send_channel(channel_obj, f"{i} - {critic_mention} - {critic_requests} completed requests", mentions = False)
+                lines = [f"{i} - {self.mention_user(user_id)} - {critic_requests} completed requests" for (i, (user_id, critic_requests)) in enumerate(critics, 1)]
+                await self.send_leaderboard(channel_obj, f"✅COMPLETION LEADERBOARD✅ - TOP {max_critics}", lines)
                 
                 await self.send_response(interaction, "Command complete.")
             except Exception as e:                
@@ -2924,35 +2666,16 @@ class CriticsGuildButler(discord.Client):
 
             try:
                 user_mention = self.mention_user(interaction.user.id)
-                channel_obj = await self.server_obj.fetch_channel(interaction.channel_id)                
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
                 channel_mention = channel_obj.jump_url
                 message = f"{user_mention} checked the mapper completed requests leaderboard (maximum of {max_mappers} critics) in {channel_mention}."
 
                 command_id = await self.log_command(db,message,interaction.user.id)
                 
-                cur = db.cursor()
+                mappers = self.rankings["completed_mapper_requests"].top(max_mappers)
 
-                query = """
-                    SELECT
-                        u.user_id,
-                        u.completed_mapper_requests
-                    FROM user u
-                    ORDER BY u.completed_mapper_requests DESC
-                    LIMIT :max_mappers
-                    """
-                
-                data = {"max_mappers":max_mappers}
-                res = cur.execute(query,data)
-                mappers = res.fetchall()       
-                
-                await self.send_channel(channel_obj, f"✅COMPLETION LEADERBOARD✅ - TOP {max_mappers} mappers")
-                                
-                i = 0
-                for mapper in mappers:
-                    i += 1
-                    (user_id, mapper_requests) = mapper
-                    mapper_mention = self.mention_user(user_id)
-                    await self.send_channel(channel_obj, f"{i} - {mapper_mention} - {mapper_requests} completed requests", mentions = False)
+                lines = [f"{i} - {self.mention_user(user_id)} - {mapper_requests} completed requests" for (i, (user_id, mapper_requests)) in enumerate(mappers, 1)]
+                await self.send_leaderboard(channel_obj, f"✅COMPLETION LEADERBOARD✅ - TOP {max_mappers} mappers", lines)
                 
                 await self.send_response(interaction, "Command complete.")
             except Exception as e:                
@@ -2960,6 +2683,52 @@ class CriticsGuildButler(discord.Client):
             
             db.close()
 
+        @self.tree.command(description=f"(Admin only) Show the leaderboard of a past season.")
+        @app_commands.default_permissions(manage_guild=True)
+        @app_commands.checks.has_permissions(manage_guild=True)
+        @app_commands.describe(board="Leaderboard to show.", season="Season to show. The last one by default.", max_users="Maximum number of users to show.")
+        async def seasonleaderboard(interaction: discord.Interaction, board: SeasonBoard, season: int = None, max_users: int = 10):
+            await self.defer(interaction)
+
+            db = self.db_connect()
+
+            try:
+                user_mention = self.mention_user(interaction.user.id)
+                channel_obj = await self.lookup_channel(interaction.channel_id)                
+                channel_mention = channel_obj.jump_url
+                message = f"{user_mention} displayed the {board.value} leaderboard of season {season if not season is None else '(last)'} (maximum of {max_users} users) in {channel_mention}."
+
+                command_id = await self.log_command(db,message,interaction.user.id)
+
+                season_row = await db.run(get_season, season)
+                if season_row is None:
+                    await self.log_error(db, f"{user_mention} tried to display the leaderboard of season {season} but it does not exist.", interaction.user.id, cause_id=command_id)
+                    await self.send_response(interaction, f"There is no such season.")
+                    db.close()
+                    return
+
+                (season_id, ended_at) = season_row
+                users = await db.run(season_leaderboard, season_id, board.value, max_users)
+
+                if board == SeasonBoard.STARS:
+                    title = f"⭐SEASON {season_id} STAR LEADERBOARD⭐ - TOP {max_users}"
+                    display = self.stars
+                elif board == SeasonBoard.MAPPER_UPVOTES:
+                    title = f"👍SEASON {season_id} UPVOTE LEADERBOARD👍 - TOP {max_users} mappers"
+                    display = self.upvotes
+                elif board == SeasonBoard.CRITIC_UPVOTES:
+                    title = f"👍SEASON {season_id} UPVOTE LEADERBOARD👍 - TOP {max_users} critics"
+                    display = self.upvotes
+
+                lines = [f"Season ended <t:{ended_at}:D>"] + [f"{i} - {self.mention_user(user_id)} - {display(value)}" for (i, (user_id, value)) in enumerate(users, 1)]
+                await self.send_leaderboard(channel_obj, title, lines)
+
+                await self.send_response(interaction, "Command complete.")
+            except Exception as e:                
+                await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
+            
+            db.close()
+
         @self.tree.command(description=f"(Admin only) Reset {self.stars(-1)} and {self.upvotes(-1)} leaderboards.")
         @app_commands.default_permissions(manage_guild=True)
         @app_commands.checks.has_permissions(manage_guild=True)        
@@ -2973,27 +2742,10 @@ class CriticsGuildButler(discord.Client):
                 message = f"{user_mention} reset the {self.stars(-1)} and {self.upvotes(-1)} leaderboards."
 
                 command_id = await self.log_command(db,message,interaction.user.id)
-                
-                cur = db.cursor()
 
-                query = """
-                    SELECT
-                        u.user_id
-                    FROM user u                    
-                    """
+                (season_id, n_users) = await self.reset_leaderboards(db, cause_id=command_id)
                 
-                res = cur.execute(query)
-                user_ids = [x[0] for x in res.fetchall()]
-
-                def reset_fun(previous):
-                    return 0
-
-                for user_id in user_ids:
-                    await self.update_stars(db,user_id,reset_fun,cause_id=command_id,update_historic=False)
-                    await self.update_mapper_upvotes(db,user_id,reset_fun,cause_id=command_id,update_historic=False)
-                    await self.update_critic_upvotes(db,user_id,reset_fun,cause_id=command_id,update_historic=False)
-                
-                await self.send_response(interaction, f"The {self.stars(-1)} and {self.upvotes(-1)} leaderboards have been reset.")
+                await self.send_response(interaction, f"The {self.stars(-1)} and {self.upvotes(-1)} leaderboards have been reset. Season {season_id} was saved with {n_users} users.")
             except Exception as e:                
                 await self.log_system(db, f"UNCAUGHT EXCEPTION! - {str(e)}")
             
@@ -3013,14 +2765,13 @@ class CriticsGuildButler(discord.Client):
 
                 command_id = await self.log_command(db,message,interaction.user.id)
                 
-                cur = db.cursor()
-
                 query = """
                     UPDATE user
                     SET claimed_tokens = 0
                     """
                 
-                res = cur.execute(query)                
+                await db.execute(query)
+                self.user_cache.clear()
                                 
                 await self.send_response(interaction, f"The {self.tokens(-1)} monthly claims have been reset for all users.")
             except Exception as e:                
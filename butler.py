@@ -1,6 +1,6 @@
 #!/usr/bin/env python3.13
 
-from database import connect, init_database
+from database import connect, init_database, close_database
 from dotenv import load_dotenv
 import json
 import os
@@ -37,6 +37,7 @@ leaderboard_task_hour = int(os.getenv("LEADERBOARD_TASK_HOUR"))
 token_cycle_task_monthday = int(os.getenv("TOKEN_CYCLE_TASK_MONTHDAY"))
 token_cycle_task_hour = int(os.getenv("TOKEN_CYCLE_TASK_HOUR"))
 token_decay = float(os.getenv("TOKEN_DECAY"))
+log_archive_days = int(os.getenv("LOG_ARCHIVE_DAYS", "90"))
 
 bot = CriticsGuildButler(db_connect=connect,
                         server_ids=server_ids,
@@ -65,10 +66,12 @@ bot = CriticsGuildButler(db_connect=connect,
                         token_cycle_task_monthday=token_cycle_task_monthday,
                         token_cycle_task_hour=token_cycle_task_hour,
                         token_decay=token_decay,
+                        log_archive_days=log_archive_days,
                         print_log=True)
 
 token = os.getenv("DISCORD_TOKEN")
 bot.run(token)
+close_database()
 
 if debug:
     input()
\ No newline at end of file
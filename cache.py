@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Cache holding at most max_size entries, evicting the least recently used one when full.
+# It is shared between the event loop and the database worker thread, hence the lock.
+class LRUCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns None on a miss.
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            self.misses += 1
+            return None
+
+    # Like get, but neither counted as a hit or miss nor marking the entry as recently used.
+    def peek(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Changes one field of a cached dict entry, if the entry is cached and has that field.
+    def update(self, key, field, value):
+        with self.lock:
+            if key in self.entries and field in self.entries[key]:
+                self.entries[key][field] = value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Cache whose entries expire ttl seconds after being put. Only used from the event loop.
+class TTLCache:
+    def __init__(self, ttl=300.0, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns None on a miss or if the entry has expired.
+    def get(self, key):
+        if key in self.entries:
+            (expires, value) = self.entries[key]
+            if time.monotonic() < expires:
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        # Entries are kept in insertion order, so the oldest ones are evicted first.
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
@@ -1,13 +1,181 @@
 import sqlite3
 import datetime
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 database_name = "database.db"
 
+# Log entries older than the archive horizon are moved here, so that the log table in the main database stays small.
+archive_database_name = "archive.db"
+
+# All SQLite work done by the bot runs on this single worker thread, so that a slow query or disk sync never blocks the event loop.
+# Having a single thread also means statements from different handlers never run at the same time.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+# Number of compiled statements kept per connection. The bot uses a few dozen distinct queries, so all of them stay prepared.
+cached_statements = 256
+
+# The single long-lived connection shared by the whole bot. It is only ever used from the database worker thread.
+shared_db = None
+
+def open_connection(tuned=True):
+    db = sqlite3.connect(database_name,isolation_level=None,check_same_thread=False,cached_statements=cached_statements)
+
+    if tuned:
+        # WAL lets readers proceed during writes and turns most commits into sequential appends.
+        # With WAL, synchronous=NORMAL is still safe against corruption and avoids an fsync on every commit.
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA cache_size=-16000")
+        db.execute("PRAGMA mmap_size=268435456")
+        db.execute("PRAGMA temp_store=MEMORY")
+
+    return db
+
+def get_connection():
+    global shared_db
+
+    if shared_db is None:
+        shared_db = open_connection()
+        attach_archive(shared_db)
+
+    return shared_db
+
+# Attaches the archive database, creating its log table if needed, and the all_log view over both logs.
+def attach_archive(db):
+    db.execute("ATTACH DATABASE ? AS archive", (archive_database_name,))
+    db.execute("PRAGMA archive.journal_mode=WAL")
+
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS archive.log
+        (
+            log_id INTEGER NOT NULL PRIMARY KEY,
+            user_id INTEGER,
+            request_id INTEGER,
+            timestamp INTEGER NOT NULL,
+            class INTEGER NOT NULL,
+            cause_id INTEGER,
+            summary TEXT
+        )
+        """)
+    db.execute("CREATE INDEX IF NOT EXISTS archive.idx_log_user_timestamp ON log (user_id, timestamp)")
+    db.execute("CREATE INDEX IF NOT EXISTS archive.idx_log_request_timestamp ON log (request_id, timestamp)")
+    db.execute("CREATE INDEX IF NOT EXISTS archive.idx_log_class_timestamp ON log (class, timestamp)")
+    db.execute("CREATE INDEX IF NOT EXISTS archive.idx_cause ON log (cause_id)")
+
+    db.execute("CREATE TEMP VIEW IF NOT EXISTS all_log AS SELECT * FROM main.log UNION ALL SELECT * FROM archive.log")
+
+def close_connection():
+    global shared_db
+
+    if not shared_db is None:
+        shared_db.close()
+        shared_db = None
+
+# Closes the shared connection once all pending database work has finished.
+def close_database():
+    executor.submit(close_connection).result()
+
 def connect():
-    return sqlite3.connect(database_name,isolation_level=None)
+    return AsyncConnection()
+
+# Awaitable handle to the shared connection. Handles are cheap, so handlers can keep creating one per event.
+class AsyncConnection:
+    def _run(self, fun, *args, **kwargs):
+        return fun(get_connection(), *args, **kwargs)
+
+    # Runs fun(db, *args, **kwargs) on the worker thread and returns its result.
+    async def run(self, fun, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(self._run, fun, *args, **kwargs))
+
+    # Runs fun(db, *args, **kwargs) on the worker thread inside a single transaction, rolling back if it raises.
+    async def transaction(self, fun, *args, **kwargs):
+        return await self.run(run_transaction, fun, *args, **kwargs)
+
+    async def fetchone(self, query, data=()):
+        return await self.run(fetchone, query, data)
+
+    async def fetchall(self, query, data=()):
+        return await self.run(fetchall, query, data)
+
+    # Returns the id of the last inserted row, if any.
+    async def execute(self, query, data=()):
+        return await self.run(execute, query, data)
+
+    # The shared connection stays open for the lifetime of the bot, see close_database.
+    def close(self):
+        pass
+
+def fetchone(db, query, data=()):
+    return db.execute(query, data).fetchone()
+
+def fetchall(db, query, data=()):
+    return db.execute(query, data).fetchall()
+
+def execute(db, query, data=()):
+    return db.execute(query, data).lastrowid
+
+def run_transaction(db, fun, *args, **kwargs):
+    db.execute("BEGIN")
+    try:
+        result = fun(db, *args, **kwargs)
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+    return result
+
+# Counters of the user table that also keep a running total that is not reset with the leaderboards.
+historic_counters = ["mapper_upvotes", "critic_upvotes", "stars"]
+
+# Raised inside a counter transaction when a change would take a counter outside its bounds, so that the whole transaction is rolled back.
+class CounterOutOfBounds(Exception):
+    pass
+
+# Raised inside a transaction to roll it back when the row it was meant to change is no longer in the expected state.
+class RowStateChanged(Exception):
+    pass
+
+# Applies delta to (or sets value on) a counter column and returns (previous, new). Must run inside a transaction.
+# SQLite's RETURNING clause only sees the updated row, so when setting a value the previous one is read first.
+def update_counter(db, table, key_column, key, counter, delta=None, value=None, historic_counter=None, minimum=None, maximum=None):
+    if delta is None:
+        previous = db.execute(f"SELECT {counter} FROM {table} WHERE {key_column} = ?", (key,)).fetchone()[0]
+        delta = value - previous
+
+    set_clause = f"{counter} = {counter} + :delta"
+    if not historic_counter is None:
+        set_clause += f", {historic_counter} = {historic_counter} + :delta"
+
+    query = f"UPDATE {table} SET {set_clause} WHERE {key_column} = :key RETURNING {counter}"
+    new = db.execute(query, {"delta":delta, "key":key}).fetchone()[0]
+
+    if (not minimum is None and new < minimum) or (not maximum is None and new > maximum):
+        raise CounterOutOfBounds(f"{counter} of {key} would become {new}")
+
+    return (new - delta, new)
+
+def update_user_counter(db, user_id, counter, delta=None, value=None, update_historic=True, minimum=None, maximum=None):
+    db.execute("INSERT OR IGNORE INTO user (user_id) VALUES (?)", (user_id,))
+
+    if update_historic and counter in historic_counters:
+        historic_counter = f"historic_{counter}"
+    else:
+        historic_counter = None
+
+    return update_counter(db, "user", "user_id", user_id, counter, delta, value, historic_counter, minimum, maximum)
+
+def update_request_counter(db, request_id, counter, delta=None, value=None, minimum=None, maximum=None):
+    return update_counter(db, "request", "thread_id", request_id, counter, delta, value, None, minimum, maximum)
 
 def init_database():
-    db = connect()
+    executor.submit(init_database_worker).result()
+
+def init_database_worker():
+    db = get_connection()
 
     cur = db.cursor()
 
@@ -22,9 +190,27 @@ def init_database():
     
     if count_version_table == 0:
         create_version_table(db)
-        v4_init(db)
-    
-    return db
+        if not v4_init(db):
+            raise RuntimeError("Could not migrate the database to v4.")
+
+    # Migrations are applied in order, stopping at the first one that fails, so that no later version is ever recorded on top of it.
+    version = database_version(db)
+    for (version_number, migrate) in migrations:
+        if version < version_number and not migrate(db):
+            raise RuntimeError(f"Could not migrate the database to v{version_number}. It was left at v{database_version(db)}.")
+
+def database_version(db):
+    version = db.execute("SELECT MAX(version_number) FROM bot_version").fetchone()[0]
+
+    # v4_init used to add its column but fail to record the version, so an empty version table means v4.
+    if version is None:
+        version = 4
+
+    return version
+
+def record_version(db, version_number):
+    timestamp = datetime.datetime.now(tz = None)
+    db.execute("INSERT INTO bot_version (version_number, init_date) VALUES (?,?)", (version_number, timestamp))
 
 # The log is a very very basic print log, since the more serious log relies on the database to begin with.
 def v4_init(db,log=True):        
@@ -44,15 +230,250 @@ def v4_init(db,log=True):
         cur.execute("""
             INSERT INTO bot_version (version_number, init_date)
             VALUES (4,?)
-            """, (timestamp))
+            """, (timestamp,))
 
     except sqlite3.Error as e:
         print(f"SQLite error when initializing v4: {e}")
-        return
+        return False
 
     if log:
         print("v4 initialized!")
 
+    return True
+
+# Adds the creation and closing dates of requests, as seconds since the epoch, backfilled from the log.
+# Requests without any log entry fall back to the creation time encoded in their thread id.
+# The log is a very very basic print log, since the more serious log relies on the database to begin with.
+def v5_init(db,log=True):
+    if log:
+        print("Initializing v5...")
+
+    def migrate(db):
+        db.execute("ALTER TABLE request ADD COLUMN created_at INTEGER")
+        db.execute("ALTER TABLE request ADD COLUMN closed_at INTEGER")
+
+        db.execute("""
+            UPDATE request
+            SET created_at = COALESCE(
+                (SELECT CAST(strftime('%s', MIN(l.timestamp), 'utc') AS INTEGER) FROM log l WHERE l.request_id = request.thread_id),
+                ((thread_id >> 22) + 1420070400000) / 1000)
+            """)
+
+        # States 3 and 4 are completed and cancelled.
+        db.execute("""
+            UPDATE request
+            SET closed_at = (SELECT CAST(strftime('%s', MAX(l.timestamp), 'utc') AS INTEGER) FROM log l WHERE l.request_id = request.thread_id)
+            WHERE state IN (3, 4)
+            """)
+
+        db.execute("CREATE INDEX idx_state_created ON request (state, created_at)")
+
+        record_version(db, 5)
+
+    try:
+        run_transaction(db, migrate)
+    except sqlite3.Error as e:
+        print(f"SQLite error when initializing v5: {e}")
+        return False
+
+    if log:
+        print("v5 initialized!")
+
+    return True
+
+# User counters that leaderboards are sorted by.
+ranked_counters = ["tokens", "stars", "historic_stars", "mapper_upvotes", "historic_mapper_upvotes", "critic_upvotes", "historic_critic_upvotes", "completed_mapper_requests", "completed_critic_requests"]
+
+# Adds an index on every ranked counter. Since user_id is the rowid, each of them covers (user_id, counter) queries.
+# The log is a very very basic print log, since the more serious log relies on the database to begin with.
+def v6_init(db,log=True):
+    if log:
+        print("Initializing v6...")
+
+    def migrate(db):
+        for counter in ranked_counters:
+            db.execute(f"CREATE INDEX idx_user_{counter} ON user ({counter})")
+
+        record_version(db, 6)
+
+    try:
+        run_transaction(db, migrate)
+    except sqlite3.Error as e:
+        print(f"SQLite error when initializing v6: {e}")
+        return False
+
+    if log:
+        print("v6 initialized!")
+
+    return True
+
+# Adds the season table, with one row per leaderboard reset, and the snapshot of every user's season counters at that reset.
+# The log is a very very basic print log, since the more serious log relies on the database to begin with.
+def v7_init(db,log=True):
+    if log:
+        print("Initializing v7...")
+
+    def migrate(db):
+        db.execute("""
+            CREATE TABLE season
+            (
+                season_id INTEGER NOT NULL PRIMARY KEY,
+                ended_at INTEGER NOT NULL,
+                log_id INTEGER REFERENCES log (log_id)
+            )
+            """)
+
+        db.execute("""
+            CREATE TABLE season_snapshot
+            (
+                season_id INTEGER NOT NULL REFERENCES season (season_id),
+                user_id INTEGER NOT NULL REFERENCES user (user_id),
+                stars INTEGER NOT NULL,
+                mapper_upvotes INTEGER NOT NULL,
+                critic_upvotes INTEGER NOT NULL,
+                PRIMARY KEY (season_id, user_id)
+            ) WITHOUT ROWID
+            """)
+
+        record_version(db, 7)
+
+    try:
+        run_transaction(db, migrate)
+    except sqlite3.Error as e:
+        print(f"SQLite error when initializing v7: {e}")
+        return False
+
+    if log:
+        print("v7 initialized!")
+
+    return True
+
+# Converts log timestamps from datetime strings in local time to seconds since the epoch, and replaces the user and request
+# indexes on the log with ones that also cover the timestamp, so that the log can be scanned by time range.
+# The log is a very very basic print log, since the more serious log relies on the database to begin with.
+def v8_init(db,log=True):
+    if log:
+        print("Initializing v8...")
+
+    def migrate(db):
+        db.execute("UPDATE log SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE typeof(timestamp) = 'text'")
+
+        db.execute("DROP INDEX IF EXISTS idx_user")
+        db.execute("DROP INDEX IF EXISTS idx_request")
+        db.execute("CREATE INDEX idx_log_user_timestamp ON log (user_id, timestamp)")
+        db.execute("CREATE INDEX idx_log_request_timestamp ON log (request_id, timestamp)")
+        db.execute("CREATE INDEX idx_log_class_timestamp ON log (class, timestamp)")
+
+        record_version(db, 8)
+
+    try:
+        run_transaction(db, migrate)
+    except sqlite3.Error as e:
+        print(f"SQLite error when initializing v8: {e}")
+        return False
+
+    if log:
+        print("v8 initialized!")
+
+    return True
+
+# Adds the table recording when each scheduled task last ran.
+# The log is a very very basic print log, since the more serious log relies on the database to begin with.
+def v9_init(db,log=True):
+    if log:
+        print("Initializing v9...")
+
+    def migrate(db):
+        db.execute("""
+            CREATE TABLE scheduled_task
+            (
+                name TEXT NOT NULL PRIMARY KEY,
+                last_run INTEGER NOT NULL
+            )
+            """)
+
+        record_version(db, 9)
+
+    try:
+        run_transaction(db, migrate)
+    except sqlite3.Error as e:
+        print(f"SQLite error when initializing v9: {e}")
+        return False
+
+    if log:
+        print("v9 initialized!")
+
+    return True
+
+# Adds the active_requests counter of every user, kept up to date by triggers on every change of state of their requests.
+# The log is a very very basic print log, since the more serious log relies on the database to begin with.
+def v10_init(db,log=True):
+    if log:
+        print("Initializing v10...")
+
+    def migrate(db):
+        db.execute("ALTER TABLE user ADD COLUMN active_requests INTEGER DEFAULT 0 NOT NULL")
+
+        # Used to count the active requests of users when the counter needs to be rebuilt.
+        db.execute("CREATE INDEX idx_request_author_state ON request (author_id, state)")
+
+        # States 1 and 2 are open and claimed, the ones that count as active.
+        db.execute("""
+            CREATE TRIGGER request_active_insert AFTER INSERT ON request
+            WHEN NEW.state IN (1, 2)
+            BEGIN
+                INSERT INTO user (user_id, active_requests) VALUES (NEW.author_id, 1)
+                ON CONFLICT (user_id) DO UPDATE SET active_requests = active_requests + 1;
+            END
+            """)
+        db.execute("""
+            CREATE TRIGGER request_active_update AFTER UPDATE OF state, author_id ON request
+            WHEN (OLD.state IN (1, 2)) != (NEW.state IN (1, 2)) OR OLD.author_id != NEW.author_id
+            BEGIN
+                UPDATE user SET active_requests = active_requests - 1 WHERE user_id = OLD.author_id AND OLD.state IN (1, 2);
+                UPDATE user SET active_requests = active_requests + 1 WHERE user_id = NEW.author_id AND NEW.state IN (1, 2);
+            END
+            """)
+        db.execute("""
+            CREATE TRIGGER request_active_delete AFTER DELETE ON request
+            WHEN OLD.state IN (1, 2)
+            BEGIN
+                UPDATE user SET active_requests = active_requests - 1 WHERE user_id = OLD.author_id;
+            END
+            """)
+
+        recount_active_requests(db)
+
+        record_version(db, 10)
+
+    try:
+        run_transaction(db, migrate)
+    except sqlite3.Error as e:
+        print(f"SQLite error when initializing v10: {e}")
+        return False
+
+    if log:
+        print("v10 initialized!")
+
+    return True
+
+# Rebuilds the active_requests counter of every user from their requests.
+def recount_active_requests(db):
+    db.execute("""
+        UPDATE user
+        SET active_requests = (SELECT COUNT(*) FROM request r WHERE r.author_id = user.user_id AND r.state IN (1, 2))
+        """)
+
+# Schema migrations, applied in order to databases older than their version number.
+migrations = [
+    (5, v5_init),
+    (6, v6_init),
+    (7, v7_init),
+    (8, v8_init),
+    (9, v9_init),
+    (10, v10_init)
+]
+
 # The log is a very very basic print log, since the more serious log relies on the database to begin with.
 def create_version_table(db,log=True):        
     if log:
@@ -155,6 +576,195 @@ def check_user(db, user_id, create=True):
     else:
         return True
 
+# Fields of the cached user state, see load_user_state.
+user_state_fields = ["tokens", "penalties", "claimed_tokens", "active_requests"]
+
+# Returns the state of a user from the cache, reading it from the database on a miss, or None if the user does not exist and create is False.
+# Runs on the worker thread, so that cache fills are ordered with respect to the writes that update the cache.
+def load_user_state(db, cache, user_id, create=True):
+    # The caller has already looked the user up in the cache and counted the hit or miss.
+    state = cache.peek(user_id)
+
+    if state is None:
+        # Creating the user is one statement that does nothing if they already exist, rather than a check followed by an insert.
+        if create:
+            db.execute("INSERT INTO user (user_id) VALUES (?) ON CONFLICT DO NOTHING", (user_id,))
+
+        row = db.execute("SELECT tokens, penalties, claimed_tokens, active_requests FROM user WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+
+        state = dict(zip(user_state_fields, row))
+        cache.put(user_id, state)
+
+    return dict(state)
+
+# Counters that are zeroed when the leaderboards are reset, and saved in season_snapshot beforehand.
+season_counters = ["stars", "mapper_upvotes", "critic_upvotes"]
+
+# Ends the current season: saves the season counters of every user who has any, then zeroes them. Must run inside a transaction.
+# Returns (season_id, number of users saved).
+def reset_season(db, log_id):
+    cur = db.execute("INSERT INTO season (ended_at, log_id) VALUES (CAST(strftime('%s','now') AS INTEGER), ?)", (log_id,))
+    season_id = cur.lastrowid
+
+    columns = ", ".join(season_counters)
+    nonzero = " OR ".join(f"{counter} != 0" for counter in season_counters)
+
+    cur = db.execute(f"INSERT INTO season_snapshot (season_id, user_id, {columns}) SELECT ?, user_id, {columns} FROM user WHERE {nonzero}", (season_id,))
+    n_users = cur.rowcount
+
+    db.execute(f"UPDATE user SET {', '.join(f'{counter} = 0' for counter in season_counters)} WHERE {nonzero}")
+
+    return (season_id, n_users)
+
+# Returns (season_id, ended_at) of the given season, or of the last one if season_id is None. None if there is no such season.
+def get_season(db, season_id=None):
+    if season_id is None:
+        return db.execute("SELECT season_id, ended_at FROM season ORDER BY season_id DESC LIMIT 1").fetchone()
+
+    return db.execute("SELECT season_id, ended_at FROM season WHERE season_id = ?", (season_id,)).fetchone()
+
+# The users with the highest value of a season counter when the season ended, as (user_id, value) pairs.
+def season_leaderboard(db, season_id, counter, limit):
+    if not counter in season_counters:
+        raise ValueError(f"{counter} is not a season counter")
+
+    query = f"""
+        SELECT s.user_id, s.{counter}
+        FROM season_snapshot s
+        WHERE s.season_id = ? AND s.{counter} > 0
+        ORDER BY s.{counter} DESC
+        LIMIT ?
+        """
+    return db.execute(query, (season_id, limit)).fetchall()
+
+# Fetches the given log entries and, if with_tree, their causal trees, all in one recursive query. With archived, entries
+# are also looked for in the archive.
+# Returns (root_id, depth, log_id, user_id, request_id, date, class, summary) rows in display order. For each entry, in the
+# order given: the chain of entries that caused it from the first one (negative depth), the entry itself (depth 0), and then
+# everything it caused, depth first.
+def fetch_log_trees(db, log_ids, with_tree=True, archived=False):
+    if len(log_ids) == 0:
+        return []
+
+    # Each table gets its own recursive step, since joining against the all_log view would copy the whole log at every step.
+    tables = ["main.log", "archive.log"] if archived else ["main.log"]
+    log_view = "all_log" if archived else "main.log"
+
+    selected = ", ".join("(?, ?)" for log_id in log_ids)
+    data = [x for (position, log_id) in enumerate(log_ids) for x in (position, log_id)]
+
+    if with_tree:
+        tree = """
+            causes (position, root_id, log_id, depth, path) AS (
+                {cause_seeds}
+                UNION ALL
+                {cause_steps}
+            ),
+            consequences (position, root_id, log_id, depth, path) AS (
+                SELECT s.position, s.log_id, s.log_id, 0, printf('%020d', s.log_id)
+                FROM selected s
+                UNION ALL
+                {consequence_steps}
+            ),
+            tree AS (SELECT * FROM causes UNION ALL SELECT * FROM consequences)
+            """.format(
+                cause_seeds = " UNION ALL ".join(f"SELECT s.position, s.log_id, l.cause_id, -1, '' FROM selected s JOIN {table} l ON l.log_id = s.log_id WHERE l.cause_id IS NOT NULL" for table in tables),
+                cause_steps = " UNION ALL ".join(f"SELECT c.position, c.root_id, l.cause_id, c.depth - 1, '' FROM causes c JOIN {table} l ON l.log_id = c.log_id WHERE l.cause_id IS NOT NULL" for table in tables),
+                consequence_steps = " UNION ALL ".join(f"SELECT c.position, c.root_id, l.log_id, c.depth + 1, c.path || printf('/%020d', l.log_id) FROM consequences c JOIN {table} l ON l.cause_id = c.log_id" for table in tables))
+    else:
+        tree = "tree AS (SELECT s.position, s.log_id AS root_id, s.log_id, 0 AS depth, '' AS path FROM selected s)"
+
+    # Causes sort by depth, the oldest first. The entry and its consequences all sort after them, in path order.
+    query = f"""
+        WITH RECURSIVE
+            selected (position, log_id) AS (VALUES {selected}),
+            {tree}
+        SELECT
+            t.root_id,
+            t.depth,
+            l.log_id,
+            l.user_id,
+            l.request_id,
+            datetime(l.timestamp, 'unixepoch', 'localtime'),
+            l.class,
+            l.summary
+        FROM tree t
+        JOIN {log_view} l ON l.log_id = t.log_id
+        ORDER BY t.position, MIN(t.depth, 0), t.path
+        """
+    return db.execute(query, data).fetchall()
+
+# Returns (timestamp, log_id) of up to limit log entries with since <= timestamp < until matching the filters, in order, starting
+# after the entry given by after. Passing the last pair returned as after pages through the log without keeping a cursor open.
+# With a filter, entries are taken in timestamp order so the (filter, timestamp) indexes are followed. Without one, they are taken
+# in id order, which follows the table itself.
+def fetch_log_page(db, since, until, after=None, user_id=None, request_id=None, log_class=None, archived=True, limit=500):
+    conditions = ["l.timestamp >= :since", "l.timestamp < :until"]
+    for (column, value) in [("user_id", user_id), ("request_id", request_id), ("class", log_class)]:
+        if not value is None:
+            conditions.append(f"l.{column} = :{column}")
+
+    if user_id is None and request_id is None and log_class is None:
+        order = "l.log_id"
+        if not after is None:
+            conditions.append("l.log_id > :after_id")
+    else:
+        order = "l.timestamp, l.log_id"
+        if not after is None:
+            conditions.append("(l.timestamp, l.log_id) > (:after_timestamp, :after_id)")
+
+    query = f"""
+        SELECT l.timestamp, l.log_id
+        FROM {"all_log" if archived else "main.log"} l
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {order}
+        LIMIT :limit
+        """
+    (after_timestamp, after_id) = after if not after is None else (None, None)
+    data = {"since":since, "until":until, "user_id":user_id, "request_id":request_id, "class":log_class, "after_timestamp":after_timestamp, "after_id":after_id, "limit":limit}
+    return db.execute(query, data).fetchall()
+
+# Generator over the log entries matching the filters, in batches of rows as returned by fetch_log_trees, so that
+# an export of any size only ever holds one batch in memory. Each batch is read when the next one is requested.
+def iter_log_batches(db, since, until, user_id=None, request_id=None, log_class=None, with_tree=False, archived=True, batch_size=500):
+    after = None
+    while True:
+        page = fetch_log_page(db, since, until, after, user_id, request_id, log_class, archived, batch_size)
+        if len(page) == 0:
+            return
+
+        yield fetch_log_trees(db, [log_id for (timestamp, log_id) in page], with_tree, archived)
+        after = page[-1]
+
+# Moves up to batch_size log entries older than cutoff (seconds since the epoch) into the archive and returns how many were moved.
+# Entries are copied before being deleted, and copying ignores entries already in the archive, so an interrupted batch is just repeated.
+# Log ids grow with time, so the oldest entries are found at the start of the table without scanning the rest.
+def archive_log_batch(db, cutoff, batch_size=1000):
+    def move(db):
+        log_ids = db.execute("SELECT log_id FROM main.log WHERE timestamp < ? ORDER BY log_id LIMIT ?", (cutoff, batch_size)).fetchall()
+        if len(log_ids) == 0:
+            return 0
+
+        data = {"first":log_ids[0][0], "last":log_ids[-1][0], "cutoff":cutoff}
+        db.execute("INSERT OR IGNORE INTO archive.log SELECT * FROM main.log WHERE log_id BETWEEN :first AND :last AND timestamp < :cutoff", data)
+        return db.execute("DELETE FROM main.log WHERE log_id BETWEEN :first AND :last AND timestamp < :cutoff", data).rowcount
+
+    return run_transaction(db, move)
+
+# Returns the last run of every scheduled task, in seconds since the epoch, by task name.
+def load_task_runs(db):
+    return dict(db.execute("SELECT name, last_run FROM scheduled_task").fetchall())
+
+def record_task_run(db, name, last_run):
+    db.execute("INSERT INTO scheduled_task (name, last_run) VALUES (?,?) ON CONFLICT (name) DO UPDATE SET last_run = excluded.last_run", (name, last_run))
+
+# Fills a RankIndex for every ranked counter, keyed by counter name.
+def load_rankings(db, rankings):
+    for (counter, index) in rankings.items():
+        index.load(db.execute(f"SELECT user_id, {counter} FROM user ORDER BY {counter} DESC").fetchall())
+
 def check_request(db, thread_id):
     cur = db.cursor()
 
@@ -164,4 +774,112 @@ def check_request(db, thread_id):
     if count == 0:
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+# Accumulates log entries and writes them in group transactions, instead of committing every entry on its own.
+# Log ids are handed out up front from an in-memory counter, so callers can use them as cause_id straight away.
+# Entries are written at most flush_interval seconds after being logged, or sooner once max_entries are waiting.
+class LogWriter:
+    def __init__(self, db, flush_interval=1.0, max_entries=100, on_error=None):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.on_error = on_error
+
+        self.entries = []
+        # Entries that could not be written because of a permanent error, as (entry, error) pairs, most recent last.
+        self.dead_letters = deque(maxlen=1000)
+        # Whether the last flush failed, so that a database that stays busy is only reported once.
+        self.failing = False
+        self.next_log_id = None
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    # Hands out the next log id. Used directly by callers that write their log entries themselves, inside their own transaction.
+    async def reserve(self):
+        if self.next_log_id is None:
+            # Ids must not collide with archived entries either, even if every entry has been archived.
+            max_log_id = (await self.db.fetchone("SELECT MAX(COALESCE((SELECT MAX(log_id) FROM main.log),0), COALESCE((SELECT MAX(log_id) FROM archive.log),0))"))[0]
+            # Another entry may have initialized the counter while we were waiting.
+            if self.next_log_id is None:
+                self.next_log_id = max_log_id + 1
+
+        log_id = self.next_log_id
+        self.next_log_id += 1
+
+        return log_id
+
+    # Returns the log id the entry will be written with.
+    async def write(self, user_id, request_id, timestamp, log_class, cause_id, summary):
+        log_id = await self.reserve()
+
+        self.entries.append((log_id, user_id, request_id, timestamp, log_class, cause_id, summary))
+        if len(self.entries) >= self.max_entries:
+            self.full.set()
+
+        return log_id
+
+    async def flush(self):
+        async with self.lock:
+            self.full.clear()
+
+            if len(self.entries) == 0:
+                return
+
+            entries = self.entries
+            self.entries = []
+
+            try:
+                await self.db.transaction(write_log_entries, entries)
+                self.failing = False
+            except sqlite3.OperationalError as e:
+                # The database is busy or locked: keep the entries so that the next flush tries again.
+                self.entries = entries + self.entries
+                await self.report(e)
+            except sqlite3.Error as e:
+                # Some entry can never be written. The entries are written one by one instead, so that only the bad ones are set aside.
+                for (i, entry) in enumerate(entries):
+                    try:
+                        await self.db.transaction(write_log_entries, [entry])
+                    except sqlite3.OperationalError:
+                        self.entries = entries[i:] + self.entries
+                        break
+                    except sqlite3.Error as entry_error:
+                        self.dead_letters.append((entry, entry_error))
+                        print(f"Dropped log entry {entry[0]} that could not be written into the database: {entry_error}")
+
+                await self.report(e)
+
+    async def report(self, e):
+        print(f"SQLite error when trying to write log entries into the database!!: {e}")
+
+        if not self.failing and not self.on_error is None:
+            self.failing = True
+            await self.on_error(e)
+
+    # Writes anything still buffered. Called when the bot shuts down.
+    async def stop(self):
+        async with self.lock:
+            if not self.task is None:
+                self.task.cancel()
+                self.task = None
+
+        await self.flush()
+
+def write_log_entries(db, entries):
+    user_ids = {(user_id,) for (log_id, user_id, request_id, timestamp, log_class, cause_id, summary) in entries if not user_id is None}
+    db.executemany("INSERT OR IGNORE INTO user (user_id) VALUES (?)", user_ids)
+    db.executemany("INSERT INTO log (log_id, user_id, request_id, timestamp, class, cause_id, summary) VALUES (?,?,?,?,?,?,?)", entries)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3.13
+
+# Exports log entries, optionally with their causal trees, to CSV or JSON Lines, for audits that are too long to read in Discord.
+# Rows are read and written one batch at a time, so the export never holds the log in memory.
+# Run it from the bot's directory, e.g.: python exportlog.py --days 90 --user 1234 --tree --format jsonl --output audit.jsonl
+
+import argparse
+import csv
+import json
+import sys
+import time
+import database
+
+# Columns of exported rows. root_id is the entry that matched the filters, and depth is the position of the row in its causal tree:
+# negative for causes, 0 for the entry itself and positive for its consequences.
+export_fields = ["root_id", "depth", "log_id", "user_id", "request_id", "date", "class", "summary"]
+
+export_formats = ["csv", "jsonl"]
+
+# Returns a function that writes a batch of rows to file in the given format. CSV files start with a header line.
+def row_writer(file, format):
+    if format == "csv":
+        writer = csv.writer(file)
+        writer.writerow(export_fields)
+        return writer.writerows
+    elif format == "jsonl":
+        def write_rows(rows):
+            for row in rows:
+                file.write(json.dumps(dict(zip(export_fields, row)), ensure_ascii=False) + "\n")
+        return write_rows
+    else:
+        raise ValueError(f"Unknown export format: {format}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export log entries to CSV or JSON Lines.")
+    parser.add_argument("--days", type=int, default=30, help="Number of past days to export.")
+    parser.add_argument("--user", type=int, help="Only export entries of this user id.")
+    parser.add_argument("--request", type=int, help="Only export entries of this request (thread id).")
+    parser.add_argument("--class", dest="log_class", type=int, help="Only export entries of this class (1 system, 2 command, 3 result, 4 error).")
+    parser.add_argument("--tree", action="store_true", help="Include the causes and consequences of every entry.")
+    parser.add_argument("--format", choices=export_formats, default="csv")
+    parser.add_argument("--output", help="File to write to. Standard output by default.")
+    args = parser.parse_args()
+
+    until = int(time.time())
+    since = until - args.days*86400
+
+    db = database.open_connection()
+    database.attach_archive(db)
+
+    if args.output is None:
+        file = sys.stdout
+    else:
+        file = open(args.output, "w", newline="", encoding="utf-8")
+
+    write_rows = row_writer(file, args.format)
+
+    n_rows = 0
+    for batch in database.iter_log_batches(db, since, until, args.user, args.request, args.log_class, args.tree):
+        write_rows(batch)
+        n_rows += len(batch)
+
+    if not args.output is None:
+        file.close()
+    db.close()
+
+    print(f"Exported {n_rows} rows.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
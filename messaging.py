@@ -0,0 +1,227 @@
+import asyncio
+import time
+from collections import deque
+from enum import Enum
+
+# Discord rejects messages longer than this many characters.
+message_limit = 2000
+
+# Groups lines into as few messages as possible without exceeding the message limit. Lines that are too long on their own are split.
+def chunk_lines(lines, limit=message_limit):
+    chunks = []
+    current = ""
+
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current = f"{current}\n{line}"
+        else:
+            chunks.append(current)
+            current = line
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+class Priority(Enum):
+    HIGH = 0
+    LOW = 1
+
+# Discord allows 5 messages every 5 seconds in a channel, and 50 requests per second overall.
+route_capacity = 5
+route_period = 5.0
+global_capacity = 50
+global_period = 1.0
+
+# Requests available in a rate limit bucket, refilled continuously at capacity/period per second.
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a request is allowed, 0 if it is allowed right now.
+    def delay(self):
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    def full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+# A queued message. send is a coroutine function taking the content to send.
+# Messages with the same merge_key may be joined into one, None meaning it is never merged.
+class Outbound:
+    def __init__(self, route, send, content, merge_key, future):
+        self.route = route
+        self.send = send
+        self.content = content
+        self.merge_key = merge_key
+        self.futures = [future]
+        self.queued = time.monotonic()
+
+# Sends every outgoing message from a background task, pacing them with a token bucket per route (channel) so bursts never hit Discord's rate limits.
+# Messages wait in priority lanes, and lower lanes are only served when no higher lane message can be sent.
+# Plain text messages that queue up for the same channel are merged into as few messages as possible, so a burst costs one request instead of many.
+# linger is how long messages in each lane wait for others to merge with them, so audit logs are sent in batches.
+# Messages to the same route are always sent in the order they were queued within a lane.
+class OutboundQueue:
+    def __init__(self, linger=None):
+        self.linger = {Priority.HIGH:0.0, Priority.LOW:2.0} if linger is None else linger
+
+        self.lanes = {priority: deque() for priority in sorted(Priority, key=lambda p: p.value)}
+        self.buckets = {}
+        self.global_bucket = TokenBucket(global_capacity, global_period)
+        # Routes with a message being sent right now.
+        self.busy = set()
+        self.sending = set()
+
+        self.pending = asyncio.Event()
+        self.task = None
+        self.stopping = False
+
+        self.sent = 0
+        self.merged = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def start(self):
+        self.stopping = False
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    # Queues a message and returns a future with the sent message, or None if the caller does not wait for it.
+    # Messages nobody waits for have their errors printed instead.
+    def put(self, route, send, content=None, priority=Priority.HIGH, merge_key=None, wait=True):
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self.lanes[priority].append(Outbound(route, send, content, merge_key, future))
+        self.pending.set()
+        return future
+
+    async def send(self, route, send, content=None, priority=Priority.HIGH, merge_key=None):
+        return await self.put(route, send, content, priority, merge_key)
+
+    def bucket(self, route):
+        if not route in self.buckets:
+            self.buckets[route] = TokenBucket(route_capacity, route_period)
+        return self.buckets[route]
+
+    # Picks the next message that can be sent, or returns how long to wait until one can.
+    def next_item(self):
+        now = time.monotonic()
+        wait = None
+
+        for (priority, lane) in self.lanes.items():
+            linger = 0.0 if self.stopping else self.linger.get(priority, 0.0)
+            seen = set()
+
+            for item in lane:
+                # Only the first message of every route is eligible, to keep their order.
+                if item.route in seen:
+                    continue
+                seen.add(item.route)
+
+                if item.route in self.busy:
+                    continue
+
+                delay = max(item.queued + linger - now, self.bucket(item.route).delay(), self.global_bucket.delay())
+                if delay <= 0:
+                    return (priority, item, None)
+                wait = delay if wait is None else min(wait, delay)
+
+        return (None, None, wait)
+
+    # Joins the messages following item in its lane that go to the same route and can be merged with it, up to the message limit.
+    def merge(self, lane, item):
+        if item.merge_key is None or item.content is None:
+            return
+
+        for other in list(lane):
+            if other.route != item.route:
+                continue
+            if other.merge_key != item.merge_key or other.content is None or len(item.content) + 1 + len(other.content) > message_limit:
+                break
+
+            lane.remove(other)
+            item.content = f"{item.content}\n{other.content}"
+            item.futures.extend(other.futures)
+            self.merged += 1
+
+    async def run(self):
+        while True:
+            (priority, item, wait) = self.next_item()
+
+            if item is None:
+                # Forget idle routes so the buckets do not grow with every channel ever used.
+                for route in [route for (route, bucket) in self.buckets.items() if bucket.full() and not route in self.busy]:
+                    del self.buckets[route]
+
+                self.pending.clear()
+                try:
+                    await asyncio.wait_for(self.pending.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            lane = self.lanes[priority]
+            lane.remove(item)
+            self.merge(lane, item)
+
+            self.bucket(item.route).take()
+            self.global_bucket.take()
+            self.busy.add(item.route)
+
+            # Different routes are sent concurrently, each route one message at a time.
+            task = asyncio.create_task(self.deliver(item))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def deliver(self, item):
+        try:
+            message = await item.send(item.content)
+            self.sent += 1
+            for future in item.futures:
+                if not future is None and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            for future in item.futures:
+                if future is None:
+                    print(f"Could not send queued message: {e}")
+                elif not future.done():
+                    future.set_exception(e)
+        finally:
+            self.busy.discard(item.route)
+            self.pending.set()
+
+    # Sends everything still queued, without lingering, and stops. Called when the bot shuts down.
+    async def stop(self, timeout=10.0):
+        self.stopping = True
+        self.pending.set()
+
+        deadline = time.monotonic() + timeout
+        while (len(self) > 0 or len(self.sending) > 0) and time.monotonic() < deadline and not self.task is None and not self.task.done():
+            await asyncio.sleep(0.1)
+
+        if not self.task is None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,64 @@
+import bisect
+import threading
+
+# Users ordered by the value of one counter, highest first, kept as a sorted list of (-value, user_id) keys.
+# Lookups of the top users and of a user's rank are binary searches, instead of sorting the user table every time.
+# Updates find the user's position with a binary search too, but inserting into and deleting from the list shifts the keys after it,
+# so each update is O(n) in the number of users. For the size of the guild that is a short memory move, cheaper than a tree structure.
+# It is updated from the database worker thread and read from the event loop, hence the lock.
+class RankIndex:
+    def __init__(self):
+        self.values = {}
+        self.keys = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    # rows are (user_id, value) pairs.
+    def load(self, rows):
+        with self.lock:
+            self.values = dict(rows)
+            self.keys = sorted((-value, user_id) for (user_id, value) in self.values.items())
+
+    # Users not in the index have the default value of every counter, 0.
+    def value(self, user_id):
+        return self.values.get(user_id, 0)
+
+    def set(self, user_id, value):
+        with self.lock:
+            self._set(user_id, value)
+
+    def add(self, user_id, delta):
+        with self.lock:
+            self._set(user_id, self.values.get(user_id, 0) + delta)
+
+    def _set(self, user_id, value):
+        if user_id in self.values:
+            i = bisect.bisect_left(self.keys, (-self.values[user_id], user_id))
+            del self.keys[i]
+
+        self.values[user_id] = value
+        bisect.insort(self.keys, (-value, user_id))
+
+    # 1 plus the number of users with a strictly higher value, so tied users share a rank.
+    def rank(self, user_id):
+        with self.lock:
+            return bisect.bisect_left(self.keys, (-self.values.get(user_id, 0),)) + 1
+
+    # The n users with the highest values, as (user_id, value) pairs.
+    def top(self, n):
+        with self.lock:
+            return [(user_id, -value) for (value, user_id) in self.keys[:n]]
+
+    # The user and up to n users on each side of them, as (rank, user_id, value) triples, best first.
+    # A user missing from the index has every counter at 0, so they are added with that value.
+    def around(self, user_id, n):
+        with self.lock:
+            if not user_id in self.values:
+                self._set(user_id, 0)
+
+            i = bisect.bisect_left(self.keys, (-self.values[user_id], user_id))
+            window = self.keys[max(0, i - n):i + n + 1]
+
+            return [(bisect.bisect_left(self.keys, (value,)) + 1, other_id, -value) for (value, other_id) in window]
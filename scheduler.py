@@ -0,0 +1,95 @@
+import asyncio
+import calendar
+import datetime
+from database import load_task_runs, record_task_run
+
+# The first time after `after` that falls on the given weekday (0 is Monday) at the given hour. Times are in UTC.
+def next_weekly(after, weekday, hour):
+    candidate = after.replace(hour=hour, minute=0, second=0, microsecond=0) + datetime.timedelta(days=(weekday - after.weekday()) % 7)
+    if candidate <= after:
+        candidate += datetime.timedelta(days=7)
+    return candidate
+
+# The first time after `after` that falls on the given day of the month at the given hour. Times are in UTC.
+# Months that are too short for that day use their last day instead of being skipped.
+def next_monthly(after, monthday, hour):
+    (year, month) = (after.year, after.month)
+    while True:
+        day = min(monthday, calendar.monthrange(year, month)[1])
+        candidate = datetime.datetime(year, month, day, hour, tzinfo=datetime.timezone.utc)
+        if candidate > after:
+            return candidate
+        (year, month) = (year + month // 12, month % 12 + 1)
+
+def next_interval(after, seconds):
+    return after + datetime.timedelta(seconds=seconds)
+
+# Runs periodic jobs at the times given by their next_run functions, sleeping in between.
+# The last run of every job is stored in the database, so a run missed while the bot was down happens as soon as it starts again.
+# A job that missed several runs is only run once.
+class Scheduler:
+    # The loop wakes up at least this often, so that clock changes and suspended machines do not delay jobs for long.
+    max_sleep = 3600
+
+    def __init__(self, db, on_error=None):
+        self.db = db
+        self.on_error = on_error
+
+        self.jobs = {}
+        self.last_runs = {}
+        self.task = None
+
+    # next_run takes the time of the last run and returns the time of the next one. run is a coroutine function.
+    def add(self, name, next_run, run):
+        self.jobs[name] = (next_run, run)
+
+    async def start(self):
+        now = self.now()
+        stored = await self.db.run(load_task_runs)
+
+        for name in self.jobs:
+            if name in stored:
+                self.last_runs[name] = datetime.datetime.fromtimestamp(stored[name], tz=datetime.timezone.utc)
+            else:
+                # A job that has never been scheduled starts counting from now rather than running right away.
+                self.last_runs[name] = now
+                await self.db.run(record_task_run, name, int(now.timestamp()))
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def now(self):
+        return datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def next_job(self):
+        return min((next_run(self.last_runs[name]), name) for (name, (next_run, run)) in self.jobs.items())
+
+    async def run(self):
+        while len(self.jobs) > 0:
+            (when, name) = self.next_job()
+
+            delay = (when - self.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(min(delay, self.max_sleep))
+                continue
+
+            await self.run_job(name)
+
+    async def run_job(self, name):
+        (next_run, run) = self.jobs[name]
+
+        try:
+            await run()
+        except Exception as e:
+            print(f"Scheduled task {name} failed: {e}")
+            if not self.on_error is None:
+                await self.on_error(name, e)
+
+        # The run is recorded even if it failed, so a failing job is not retried in a tight loop.
+        self.last_runs[name] = self.now()
+        await self.db.run(record_task_run, name, int(self.last_runs[name].timestamp()))
+
+    def stop(self):
+        if not self.task is None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,46 @@
+import asyncio
+import importlib.util
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import LRUCache
+
+@unittest.skipUnless(importlib.util.find_spec("discord"), "discord.py is not installed")
+class LookupMemberTest(unittest.TestCase):
+    def make_butler(self, gateway_guild, fetched_member=None):
+        from bot import CriticsGuildButler
+
+        async def fetch_member(user_id):
+            return fetched_member
+
+        butler = types.SimpleNamespace(
+            server_obj=types.SimpleNamespace(id=1, fetch_member=fetch_member),
+            get_guild=lambda guild_id: gateway_guild,
+            lookup_counts={"gateway":0, "cache":0, "rest":0},
+            object_cache=LRUCache(10))
+        butler.lookup = types.MethodType(CriticsGuildButler.lookup, butler)
+        butler.get_member = types.MethodType(CriticsGuildButler.get_member, butler)
+        butler.lookup_member = types.MethodType(CriticsGuildButler.lookup_member, butler)
+        return butler
+
+    def test_cached_member_is_a_gateway_hit(self):
+        member = object()
+        guild = types.SimpleNamespace(get_member=lambda user_id: member)
+        butler = self.make_butler(guild)
+
+        self.assertIs(asyncio.run(butler.lookup_member(42)), member)
+        self.assertEqual(butler.lookup_counts, {"gateway":1, "cache":0, "rest":0})
+
+    def test_member_is_fetched_before_the_gateway_guild_is_known(self):
+        member = object()
+        butler = self.make_butler(None, member)
+
+        self.assertIs(asyncio.run(butler.lookup_member(42)), member)
+        self.assertEqual(butler.lookup_counts, {"gateway":0, "cache":0, "rest":1})
+
+if __name__ == "__main__":
+    unittest.main()